@@ -0,0 +1,193 @@
+# coding=utf-8
+# replays G-code through LevelAnythingPlugin.on_gcode_queuing for several meshes and stores the results as JSON
+#
+# usage: python benchmark/bench_pipeline.py [--output results.json] [--compare old.json] [file.gcode ...]
+# without files, synthetic G-code is used
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+from time import time
+from timeit import default_timer as timer
+
+from stubs import make_matrix, make_plugin
+from octoprint.util.comm import gcode_command_for_cmd
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MESHES = (3, 10, 50)
+
+def preamble():
+    return ['G28', 'G90', 'M82', 'G92 E0', 'G0 Z0.2 F3000']
+
+# short zig-zag lines like the solid infill of a first layer, with layer changes below the fading height
+def dense_infill(count, rnd):
+    lines = preamble()
+    e, z = 0.0, 0.2
+    while len(lines) < count:
+        x0, y0 = rnd.uniform(20, 160), rnd.uniform(20, 160)
+        for n in range(200):
+            y = y0 + n * 0.4
+            x = x0 + (20 if n % 2 else 0)
+            e += 0.7
+            lines.append('G1 X%.3f Y%.3f E%.5f' % (x, y, e))
+        z += 0.2
+        lines.append('G1 Z%.3f F600' % z)
+        if z > 1.8:
+            z = 0.2
+            lines.append('G0 Z0.2')
+    return lines[:count]
+
+# long travel moves across the whole bed, these get divided the most
+def long_travel(count, rnd):
+    lines = preamble()
+    while len(lines) < count:
+        lines.append('G0 X%.3f Y%.3f F7200' % (rnd.uniform(0, 200), rnd.uniform(0, 200)))
+    return lines[:count]
+
+# extruder in relative mode, every move has a small E value
+def relative_e(count, rnd):
+    lines = preamble() + ['M83']
+    x, y = 100.0, 100.0
+    while len(lines) < count:
+        x = min(max(x + rnd.uniform(-10, 10), 0), 200)
+        y = min(max(y + rnd.uniform(-10, 10), 0), 200)
+        lines.append('G1 X%.3f Y%.3f E%.5f' % (x, y, rnd.uniform(0.01, 0.5)))
+    return lines[:count]
+
+# extrusion distance is reset regularly, like slicers do after each layer or retraction
+def g92_resets(count, rnd):
+    lines = preamble()
+    e = 0.0
+    while len(lines) < count:
+        for n in range(20):
+            e += rnd.uniform(0.01, 0.5)
+            lines.append('G1 X%.3f Y%.3f E%.5f' % (rnd.uniform(0, 200), rnd.uniform(0, 200), e))
+        lines.append('G92 E0')
+        e = 0.0
+    return lines[:count]
+
+# layers above the fading height, like most of a print
+def upper_layers(count, rnd):
+    lines = preamble()
+    e, z = 0.0, 2.0
+    while len(lines) < count:
+        z += 0.2
+        lines.append('G1 Z%.3f F600' % z)
+        for n in range(100):
+            e += rnd.uniform(0.01, 0.5)
+            lines.append('G1 X%.3f Y%.3f E%.5f' % (rnd.uniform(20, 180), rnd.uniform(20, 180), e))
+    return lines[:count]
+
+# short arcs like the output of ArcWelder, alternating direction and mostly small radii
+def arcs(count, rnd):
+    lines = preamble() + ['G0 X100 Y100']
+    x, y, e = 100.0, 100.0, 0.0
+    while len(lines) < count:
+        radius = rnd.choice((2, 5, 20))
+        nx = min(max(x + rnd.uniform(-radius, radius), 0), 200)
+        ny = min(max(y + rnd.uniform(-radius, radius), 0), 200)
+        e += 0.05 * radius
+        lines.append('G%d X%.3f Y%.3f R%.3f E%.5f' % (rnd.choice((2, 3)), nx, ny, radius, e))
+        x, y = nx, ny
+    return lines[:count]
+
+SCENARIOS = dict(
+    dense_infill = dense_infill, long_travel = long_travel, relative_e = relative_e, g92_resets = g92_resets, arcs = arcs,
+    upper_layers = upper_layers
+)
+
+def load_file(path):
+    with open(path) as f:
+        return [l.strip() for l in f if l.strip() and not l.strip().startswith(';')]
+
+# runs all lines through the hook, returns lines per second and emitted commands per line
+def replay(plugin, commands):
+    emitted = 0
+    start = timer()
+    for cmd, gcode in commands:
+        result = plugin.on_gcode_queuing(None, 'queuing', cmd, None, gcode)
+        if isinstance(result, list):
+            emitted += len(result)
+        elif result is None or isinstance(result, str):
+            emitted += 1
+    elapsed = timer() - start
+    return len(commands) / elapsed, emitted / len(commands)
+
+def run(name, lines, size):
+    profile = dict(min_x = 0, min_y = 0, max_x = 200, max_y = 200, count_x = size, count_y = size, divide = 10)
+    profile['matrix'] = make_matrix(profile, size, size)
+    commands = [(l, gcode_command_for_cmd(l)) for l in lines]
+
+    gc.collect()
+    rate, per_line = replay(make_plugin(profile), commands)
+    peak = None
+    if tracemalloc is not None:
+        # memory is measured in a separate run, tracing slows everything down
+        plugin = make_plugin(profile)
+        tracemalloc.start()
+        replay(plugin, commands)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = dict(
+        scenario = name, mesh = '%dx%d' % (size, size), lines = len(lines),
+        lines_per_second = rate, commands_per_line = per_line, peak_memory = peak
+    )
+    print('%-14s %-6s %10d lines/s %8.2f commands/line %10s bytes peak' % (
+        name, result['mesh'], rate, per_line, peak if peak is not None else '-'
+    ))
+    return result
+
+def compare(results, path, threshold):
+    with open(path) as f:
+        previous = dict(((r['scenario'], r['mesh']), r) for r in json.load(f)['results'])
+    regressions = 0
+    print('\ncompared to %s' % path)
+    for r in results:
+        old = previous.get((r['scenario'], r['mesh']))
+        if old is None:
+            continue
+        change = r['lines_per_second'] / old['lines_per_second'] - 1
+        regression = change < -threshold
+        regressions += regression
+        print('%-14s %-6s %+7.1f%%%s' % (r['scenario'], r['mesh'], change * 100, '  REGRESSION' if regression else ''))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs = '*', help = 'G-code files to replay instead of synthetic scenarios')
+    parser.add_argument('--lines', type = int, default = 50000, help = 'lines per synthetic scenario')
+    parser.add_argument('--output', help = 'write results to this JSON file')
+    parser.add_argument('--compare', help = 'compare with results from a previous run')
+    parser.add_argument('--threshold', type = float, default = 0.1, help = 'slowdown reported as regression, 0.1 = 10%%')
+    parser.add_argument('--label', default = '', help = 'name of this run, e.g. a version or commit')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    if args.files:
+        sources = [(path, load_file(path)) for path in args.files]
+    else:
+        sources = [(name, SCENARIOS[name](args.lines, rnd)) for name in sorted(SCENARIOS)]
+
+    results = [run(name, lines, size) for name, lines in sources for size in MESHES]
+    data = dict(
+        label = args.label, timestamp = time(), python = platform.python_version(),
+        numpy = numpy.__version__ if numpy is not None else None, results = results
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent = 2)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
@@ -0,0 +1,87 @@
+# coding=utf-8
+# probes a simulated printer with different grid sizes, probe orders and lift heights, and checks the resulting
+# matrix against the simulated surface
+#
+# usage: python benchmark/bench_probing.py [--output results.json] [--time-scale 0.01] [--noise 0.01 --samples 3]
+# printer time is the simulated duration on a real printer, wall time includes the time scale and the plugin
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import json
+import platform
+import sys
+from time import sleep, time
+from timeit import default_timer as timer
+
+from stubs import SimulatedPrinter, make_plugin, surface
+from octoprint_levelanything.probing import grid_points
+
+def run(args, mode, size, order, lift):
+    profile = dict(
+        min_x = 0, min_y = 0, max_x = 200, max_y = 200, count_x = size, count_y = size, probe_mode = mode,
+        probe_order = order, lift = lift, probe_samples = args.samples, probe_spread = args.spread
+    )
+    if mode == 'scattered':
+        # the grid positions entered as scattered points, which makes the results comparable
+        profile['probe_points'] = '\n'.join('%.3f, %.3f' % (p[1], p[2]) for p in grid_points(profile))
+    printer = SimulatedPrinter(
+        surface, args.probe_time, noise = args.noise, drop = args.drop, time_scale = args.time_scale, seed = args.seed
+    )
+    plugin = make_plugin(profile, dict(response_timeout = args.timeout), printer)
+    printer.start(plugin)
+
+    # what the probe_start API command does, without checking permissions
+    start = timer()
+    plugin.load_profiles()
+    plugin.set_status('PROBING', 'Probing started')
+    plugin.probe_start()
+    while plugin.status == 'PROBING':
+        sleep(0.001)
+    elapsed = timer() - start
+    printer.stop()
+
+    matrix = plugin.profile['matrix'] if plugin.status == 'IDLE' else []
+    errors = [abs(p[2] - surface(p[0], p[1])) for p in matrix]
+    result = dict(
+        mode = mode, size = size, order = order, lift = lift, status = plugin.status, points = len(matrix),
+        probes = printer.probes, dropped = printer.dropped, printer_seconds = printer.elapsed, wall_seconds = elapsed,
+        max_error = max(errors) if errors else None,
+        rms_error = (sum(e * e for e in errors) / len(errors)) ** 0.5 if errors else None
+    )
+    print('%-9s %3dx%-3d %-10s lift %-4g %-6s %4d points %4d probes %8.1f s printer %7.2f s wall %s' % (
+        mode, size, size, order, lift, plugin.status, len(matrix), printer.probes, printer.elapsed, elapsed,
+        'max error %.4f rms %.4f' % (result['max_error'], result['rms_error']) if errors else ''
+    ))
+    return result
+
+def values(text, cast):
+    return [cast(v) for v in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default = 'grid', help = 'probe modes, comma separated: grid, scattered, adaptive')
+    parser.add_argument('--sizes', default = '3,5,7', help = 'grid sizes, comma separated')
+    parser.add_argument('--orders', default = 'raster,serpentine,shortest', help = 'probe orders, comma separated')
+    parser.add_argument('--lifts', default = '0,2', help = 'lift heights, comma separated')
+    parser.add_argument('--probe-time', type = float, default = 0.5, help = 'printer seconds per G30')
+    parser.add_argument('--time-scale', type = float, default = 0.01, help = 'wall seconds per printer second')
+    parser.add_argument('--noise', type = float, default = 0.0, help = 'standard deviation of probe readings')
+    parser.add_argument('--samples', type = int, default = 1, help = 'probe_samples of the profile')
+    parser.add_argument('--spread', type = float, default = 0.01, help = 'probe_spread of the profile')
+    parser.add_argument('--drop', type = float, default = 0.0, help = 'fraction of probe responses which are lost')
+    parser.add_argument('--timeout', type = float, default = 5.0, help = 'response_timeout in wall seconds')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--output', help = 'write results to this JSON file')
+    parser.add_argument('--label', default = '', help = 'name of this run, e.g. a version or commit')
+    args = parser.parse_args()
+
+    results = [
+        run(args, mode, size, order, lift)
+        for mode in values(args.modes, str) for size in values(args.sizes, int)
+        for order in values(args.orders, str) for lift in values(args.lifts, float)
+    ]
+    if args.output:
+        data = dict(label = args.label, timestamp = time(), python = platform.python_version(), results = results)
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent = 2)
+    if any(r['status'] != 'IDLE' for r in results) and not args.drop:
+        sys.exit(1)
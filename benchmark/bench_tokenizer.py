@@ -0,0 +1,131 @@
+# coding=utf-8
+# compares the single-pass tokenizer against the previous regex based parsing and rewriting of moves
+#
+# usage: python benchmark/bench_tokenizer.py [file.gcode ...]
+# without arguments, synthetic slicer-like output is used
+from __future__ import absolute_import, division, print_function, unicode_literals
+import math
+import os
+import random
+import re
+import sys
+from functools import partial
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from octoprint_levelanything.gcode import GcodeLine
+
+# previous implementation, kept here as reference
+regex_coords = [
+    re.compile('X([\-\d\.]+)', re.IGNORECASE),
+    re.compile('Y([\-\d\.]+)', re.IGNORECASE),
+    re.compile('Z([\-\d\.]+)', re.IGNORECASE),
+    re.compile('E([\-\d\.]+)', re.IGNORECASE)
+]
+output = ['X%.3f', 'Y%.3f', 'Z%.3f', 'E%.3f']
+
+def legacy_sub_coordinates(command, original_target, coordinates, position):
+    for i in range(4):
+        if original_target[i] == coordinates[i]:
+            continue
+        match = regex_coords[i].search(command)
+        if match:
+            command = command[:match.start()] + (output[i] % coordinates[i]) + command[match.end():]
+        elif position[i] != coordinates[i]:
+            command = command + ' ' + (output[i] % coordinates[i])
+    return command
+
+# segment points are calculated up front, like the queuing hook does with the default profile,
+# so only parsing and rewriting of the command is measured
+DIVIDE = 30.0
+
+def prepare(moves):
+    line = GcodeLine()
+    position = [100.0, 100.0, 0.2, 0.0]
+    jobs = []
+    for cmd in moves:
+        coords = line.parse(cmd).coords
+        target = [coords[i] if coords[i] is not None else position[i] for i in range(4)]
+        length = math.sqrt((position[0] - target[0]) ** 2 + (position[1] - target[1]) ** 2)
+        factor = int(math.ceil(length / DIVIDE)) if length > DIVIDE else 1
+        lengths = [(target[i] - position[i]) / factor for i in range(4)]
+        points = []
+        for n in range(1, factor + 1):
+            move_point = [position[i] + lengths[i] * n for i in range(4)]
+            move_point[2] += 0.1
+            points.append(move_point)
+        jobs.append((cmd, position, points))
+        position = target
+    return jobs
+
+def legacy_rewrite(cmd, position, points):
+    index = cmd.find(';')
+    if index != -1:
+        cmd = cmd[:index]
+    match = [r.search(cmd) for r in regex_coords]
+    target = [float(match[i].group(1)) if match[i] else position[i] for i in range(4)]
+    return [legacy_sub_coordinates(cmd, target, p, position) for p in points]
+
+def tokenizer_rewrite(line, cmd, position, points):
+    coords = line.parse(cmd).coords
+    target = [coords[i] if coords[i] is not None else position[i] for i in range(4)]
+    return [line.format(target, p, position) for p in points]
+
+# output similar to common slicers: perimeters and infill with feed rate changes, travel moves,
+# retractions and comments
+def synthetic_gcode(count, seed = 1):
+    rnd = random.Random(seed)
+    lines = []
+    x, y, e = 100.0, 100.0, 0.0
+    while len(lines) < count:
+        lines.append(';TYPE:%s' % rnd.choice(['WALL-OUTER', 'WALL-INNER', 'FILL', 'SKIN']))
+        lines.append('G1 F2700 E%.5f' % (e - 1))
+        x, y = rnd.uniform(0, 200), rnd.uniform(0, 200)
+        lines.append('G0 F7200 X%.3f Y%.3f' % (x, y))
+        lines.append('G1 F2700 E%.5f' % e)
+        # mostly short extrusions, every now and then a long infill line
+        long_lines = rnd.random() < 0.2
+        for n in range(rnd.randint(5, 40)):
+            step = rnd.uniform(20, 120) if long_lines else rnd.uniform(0.5, 15)
+            angle = rnd.uniform(0, 2 * math.pi)
+            x = min(max(x + math.cos(angle) * step, 0), 200)
+            y = min(max(y + math.sin(angle) * step, 0), 200)
+            e += step * 0.033
+            if n == 0:
+                lines.append('G1 F1500 X%.3f Y%.3f E%.5f' % (x, y, e))
+            else:
+                lines.append('G1 X%.3f Y%.3f E%.5f' % (x, y, e))
+    return lines[:count]
+
+def load_moves(paths):
+    lines = []
+    for path in paths:
+        with open(path) as f:
+            lines.extend(l.strip() for l in f)
+    return lines
+
+def run(name, jobs, func):
+    start = timer()
+    for job in jobs:
+        func(*job)
+    elapsed = timer() - start
+    rate = len(jobs) / elapsed
+    print('%-10s %10d lines/s' % (name, rate))
+    return rate
+
+if __name__ == '__main__':
+    lines = load_moves(sys.argv[1:]) if len(sys.argv) > 1 else synthetic_gcode(200000)
+    # only moves are rewritten, everything else passes the hook untouched
+    moves = [l for l in lines if l[:3].upper() in ('G0 ', 'G1 ', 'G00', 'G01')]
+    jobs = prepare(moves)
+    line = GcodeLine()
+
+    # both implementations have to produce the same commands
+    for job in jobs[:1000]:
+        a, b = legacy_rewrite(*job), tokenizer_rewrite(line, *job)
+        assert [GcodeLine(c).coords for c in a] == [GcodeLine(c).coords for c in b], (job[0], a, b)
+
+    print('%d moves, %d segments' % (len(jobs), sum(len(j[2]) for j in jobs)))
+    legacy = run('regex', jobs, legacy_rewrite)
+    tokenizer = run('tokenizer', jobs, partial(tokenizer_rewrite, line))
+    print('speedup    %10.2fx' % (tokenizer / legacy))
@@ -0,0 +1,197 @@
+# coding=utf-8
+# minimal stand-ins for the objects OctoPrint injects into the plugin, to run it without a server
+from __future__ import absolute_import, division, print_function, unicode_literals
+from threading import Thread
+from time import sleep
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from octoprint_levelanything import LevelAnythingPlugin
+
+class StubSettings(object):
+
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path):
+        return self.values[path[0]]
+
+    def get_boolean(self, path):
+        return bool(self.values[path[0]])
+
+    def get_int(self, path):
+        return int(self.values[path[0]])
+
+    def get_float(self, path):
+        return float(self.values[path[0]])
+
+    def set(self, path, value):
+        self.values[path[0]] = value
+
+    def save(self):
+        pass
+
+class StubPluginManager(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, identifier, data):
+        self.messages.append(data)
+
+class StubPrinter(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def commands(self, commands):
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        self.sent.extend(commands)
+
+regex_word = re.compile('([XYZF])([-+]?[0-9]*\\.?[0-9]+)')
+
+# executes commands one after another in its own thread like firmware does, moves and probing take time
+# G30 lowers the probe at probe_speed (mm/s) until it hits the surface, then takes probe_time to settle and
+# reports the height at the current position through on_gcode_received of the plugin, with gaussian
+# noise of the given standard deviation, a fraction of drop responses is lost, which makes probing time out
+# every command is acknowledged with ok and temperatures are reported in between, like a chatty firmware
+# latencies are in printer seconds, they are slept multiplied by time_scale, elapsed adds them up unscaled
+class SimulatedPrinter(object):
+
+    def __init__(
+        self, surface, probe_time = 0.5, probe_speed = 5.0, home_time = 5.0, noise = 0.0, drop = 0.0, time_scale = 1.0,
+        seed = 1
+    ):
+        self.surface = surface
+        self.probe_time = probe_time
+        self.probe_speed = probe_speed
+        self.home_time = home_time
+        self.noise = noise
+        self.drop = drop
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.plugin = None
+        self.queue = Queue()
+        self.sent = []
+        self.position = [0.0, 0.0, 0.0]
+        self.feed = 3000.0
+        self.relative = False
+        self.elapsed = 0.0
+        self.probes = 0
+        self.dropped = 0
+
+    # starts executing commands, responses are sent to the given plugin
+    def start(self, plugin):
+        self.plugin = plugin
+        thread = Thread(target = self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def commands(self, commands):
+        if not isinstance(commands, (list, tuple)):
+            commands = [commands]
+        self.sent.extend(commands)
+        for cmd in commands:
+            self.queue.put(cmd)
+
+    def run(self):
+        while True:
+            cmd = self.queue.get()
+            if cmd is None:
+                return
+            self.execute(cmd)
+            self.respond('ok')
+            if len(self.sent) % 10 == 0:
+                self.respond('T:210.00 /210.00 B:60.00 /60.00 @:64 B@:0')
+
+    def execute(self, cmd):
+        gcode = cmd.split(' ', 1)[0].upper()
+        if gcode == 'G90':
+            self.relative = False
+        elif gcode == 'G91':
+            self.relative = True
+        elif gcode == 'G28':
+            self.position = [0.0, 0.0, 0.0]
+            self.wait(self.home_time)
+        elif gcode in ('G0', 'G1'):
+            target = list(self.position)
+            for letter, value in regex_word.findall(cmd.upper()):
+                if letter == 'F':
+                    self.feed = float(value)
+                else:
+                    i = 'XYZ'.index(letter)
+                    target[i] = target[i] + float(value) if self.relative else float(value)
+            distance = sum((a - b) ** 2 for a, b in zip(target, self.position)) ** 0.5
+            self.position = target
+            self.wait(distance / (self.feed / 60.0))
+        elif gcode == 'G30':
+            x, y = self.position[0], self.position[1]
+            z = self.surface(x, y)
+            self.wait(self.probe_time + max(self.position[2] - z, 0) / self.probe_speed)
+            self.position[2] = z
+            self.probes += 1
+            if self.random.random() < self.drop:
+                self.dropped += 1
+                return
+            if self.noise > 0:
+                z += self.random.gauss(0, self.noise)
+            self.respond('Bed X: %.3f Y: %.3f Z: %.3f' % (x, y, z))
+
+    def wait(self, seconds):
+        self.elapsed += seconds
+        if seconds * self.time_scale > 0:
+            sleep(seconds * self.time_scale)
+
+    def respond(self, line):
+        self.plugin.on_gcode_received(None, line)
+
+# smooth, slightly tilted and warped surface
+def surface(x, y):
+    return 0.001 * x - 0.0005 * y + 0.0001 * ((x - 100) ** 2 + (y - 100) ** 2) / 100
+
+# regular grid of the surface
+def make_matrix(profile, count_x, count_y):
+    matrix = []
+    for y in range(count_y):
+        for x in range(count_x):
+            px = profile['min_x'] + (profile['max_x'] - profile['min_x']) * x / max(count_x - 1, 1)
+            py = profile['min_y'] + (profile['max_y'] - profile['min_y']) * y / max(count_y - 1, 1)
+            matrix.append([px, py, surface(px, py)])
+    return matrix
+
+# creates a plugin with the given profile values and settings, ready to process commands
+def make_plugin(profile = None, settings = None, printer = None):
+    plugin = LevelAnythingPlugin()
+    values = plugin.get_settings_defaults()
+    profiles = json.loads(values['profiles'])
+    selected = dict(profiles['disabled'])
+    selected.update(profile or dict())
+    profiles['bench'] = selected
+    values.update(profiles = json.dumps(profiles), selected_profile = 'bench', stats_enabled = False)
+    values.update(settings or dict())
+
+    plugin._identifier = 'levelanything'
+    plugin._plugin_version = 'bench'
+    plugin._settings = StubSettings(values)
+    plugin._plugin_manager = StubPluginManager()
+    plugin._printer = printer or StubPrinter()
+    plugin._logger = logging.getLogger('octoprint.plugins.levelanything')
+    data_folder = tempfile.mkdtemp(prefix = 'levelanything-')
+    plugin.get_plugin_data_folder = lambda: data_folder
+    plugin.on_after_startup()
+    return plugin
@@ -1,75 +1,222 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function, unicode_literals
 from octoprint.server import user_permission
-from threading import Thread, Timer, Event
+from octoprint.events import Events
+from octoprint.filemanager import valid_file_type
+from octoprint.filemanager.util import StreamWrapper
+from octoprint.util import RepeatedTimer
+from .mesh import CachedMesh, mesh_from_profile
+from .leveler import Leveler
+from .prelevel import PrelevelStream, header_command, leveled_path, leveled_suffix, make_header, parse_header, read_header
+from .profiles import ProfileSnapshot, ProfileStore, pack_matrix
+from .shared import SharedMeshCache
+from .probing import AdaptiveProbe, ProbeJob, grid_points, scattered_points
+from .responses import ResponseRegistry
+from .stats import HookStats
+from threading import Lock, RLock, Thread, Timer
 from time import time
+from timeit import default_timer as timer
 import octoprint.plugin
 import flask
 import json
-import math
+import os
 import re
 
 class LevelAnythingPlugin(octoprint.plugin.SettingsPlugin,
                      octoprint.plugin.AssetPlugin,
                      octoprint.plugin.TemplatePlugin,
                      octoprint.plugin.SimpleApiPlugin,
-                     octoprint.plugin.StartupPlugin):
-
-    # globals
-    status = 'IDLE'
-    profile = dict()
-    profiles = dict()
-    position = [float('nan'), float('nan'), float('nan'), 0.0]
-    position_absolute = True
-    extruder_absolute = True
-    regex_coords = [
-        re.compile('X([\-\d\.]+)', re.IGNORECASE),
-        re.compile('Y([\-\d\.]+)', re.IGNORECASE),
-        re.compile('Z([\-\d\.]+)', re.IGNORECASE),
-        re.compile('E([\-\d\.]+)', re.IGNORECASE)
-    ]
-    output = ['X%.3f', 'Y%.3f', 'Z%.3f', 'E%.3f']
+                     octoprint.plugin.StartupPlugin,
+                     octoprint.plugin.EventHandlerPlugin):
+
     regex_pos = re.compile('(?:ok )?X:([\-\d\.]+) Y:([\-\d\.]+) Z:([\-\d\.]+) E:([\-\d\.]+)')
-    regex_probe = re.compile('Bed X: ([0-9\.\-]+) Y: ([0-9\.\-]+) Z: ([0-9\.\-]+)')
-    command_event = command_regex = command_match = None
+    # probed points are sent to the UI together, at most this many seconds after they were probed
+    point_interval = 0.25
+
+    def __init__(self):
+        # state of this instance, nothing is shared between printers
+        self.status = 'IDLE'
+        self.profile = dict()
+        self.profiles = dict()
+        self.store = None
+        self.profile_key = None
+        self.mesh = None
+        self.snapshot = None
+        self.leveler = None
+        self.prelevel_print = False
+        # a file leveled with another matrix is being printed, its lines are dropped until the print is cancelled
+        self.prelevel_refused = False
+        self.stats = None
+        self.stats_timer = None
+        self.probe_job = None
+        # responses expected from the printer, received lines are only matched while there are any
+        self.responses = ResponseRegistry()
+        # matrices shared with other instances, and the modification time of the one currently used
+        self.shared = None
+        self.shared_mtime = None
+        self.shared_timer = None
+        # profiles and meshes are loaded from the API, settings, probing and shared matrix threads, the profile and
+        # its mesh must be replaced together, reentrant because loading the profiles also updates the mesh
+        self.profile_lock = RLock()
+        # probed points not sent to the UI yet
+        self.points = []
+        self.points_lock = Lock()
+        self.points_timer = None
 
     def on_after_startup(self):
+        # position tracking and rewriting of commands sent to the printer, the profile is set by load_profiles
+        self.leveler = Leveler(None)
         # load saved profiles from settings for fast access
-        self.profiles = json.loads(self._settings.get(['profiles']))
-        # save a reference to the selected profile for extra fast access
-        self.profile = self.profiles[self._settings.get(['selected_profile'])]
+        self.store = ProfileStore(self.get_matrix_folder())
+        if self._settings.get(['shared_folder']):
+            self.shared = SharedMeshCache(self._settings.get(['shared_folder']))
+        # measure the time spent in the queuing hook
+        if self._settings.get_boolean(['stats_enabled']):
+            self.stats = self.leveler.stats = HookStats()
+            if self._settings.get_float(['stats_interval']) > 0:
+                self.stats_timer = RepeatedTimer(self._settings.get_float(['stats_interval']), self.send_stats)
+                self.stats_timer.start()
+        self.load_profiles()
+        # pick up matrices probed by other instances
+        if self.shared is not None and self._settings.get_float(['shared_interval']) > 0:
+            self.shared_timer = RepeatedTimer(self._settings.get_float(['shared_interval']), self.check_shared)
+            self.shared_timer.start()
+
+    def get_profile_defaults(self):
+        return dict(
+            matrix = [],
+            matrix_updated = 0.0,
+            matrix_variance = [],
+            min_x = 0,
+            min_y = 0,
+            max_x = 200,
+            max_y = 200,
+            count_x = 5,
+            count_y = 5,
+            offset_x = 0,
+            offset_y = 0,
+            offset_z = 0,
+            lift = 0,
+            lift_feed = 300,
+            probe_order = 'raster',
+            probe_mode = 'grid',
+            refine_tolerance = 0.05,
+            refine_depth = 2,
+            probe_samples = 1,
+            probe_spread = 0.01,
+            probe_points = '',
+            fixture_id = '',
+            fade = 2,
+            divide = 30,
+            divide_tolerance = 0,
+            arc_tolerance = 0.01,
+            coalesce_tolerance = 0,
+            interpolation = 'bilinear',
+            safe_homing = False,
+            home_x = 100,
+            home_y = 100,
+            home_feed = 3000
+        )
 
     def get_settings_defaults(self):
         return dict(
-            profiles = json.dumps(dict(disabled = dict(
-                matrix = [],
-                matrix_updated = 0.0,
-                min_x = 0,
-                min_y = 0,
-                max_x = 200,
-                max_y = 200,
-                count_x = 5,
-                count_y = 5,
-                offset_x = 0,
-                offset_y = 0,
-                offset_z = 0,
-                lift = 0,
-                lift_feed = 300,
-                fade = 2,
-                divide = 30,
-                safe_homing = False,
-                home_x = 100,
-                home_y = 100,
-                home_feed = 3000
-            ))),
+            profiles = json.dumps(dict(disabled = self.get_profile_defaults())),
             selected_profile = 'disabled',
             response_timeout = 60.0,
+            prelevel_uploads = False,
+            stats_enabled = False,
+            stats_interval = 0,
+            offset_cache_resolution = 0,
+            offset_cache_size = 100000,
+            shared_folder = '',
+            shared_interval = 10.0,
             debug = False
         )
+
+    def get_settings_version(self):
+        return 10
+
+    def on_settings_migrate(self, target, current):
+        # profiles created by older versions are missing newer keys, add them with their default values
+        profiles = json.loads(self._settings.get(['profiles']))
+        store = ProfileStore(self.get_matrix_folder())
+        for name, profile in profiles.items():
+            for key, value in self.get_profile_defaults().items():
+                profile.setdefault(key, value)
+            # matrices used to be stored in the settings, move them to their files
+            if profile['matrix']:
+                store.write_matrix(name, profile['matrix'])
+        self._settings.set(['profiles'], store.dumps(profiles))
+
+    def on_settings_save(self, data):
+        with self.profile_lock:
+            if 'profiles' in data:
+                # matrices are only changed by probing, don't save the copies sent by the UI
+                profiles = json.loads(data['profiles'])
+                for name, profile in profiles.items():
+                    stored = self.store.profiles.get(name)
+                    profile['matrix_updated'] = stored['matrix_updated'] if stored else 0.0
+                for name in set(self.store.profiles) - set(profiles):
+                    self.store.delete_matrix(name)
+                data['profiles'] = self.store.dumps(profiles)
+            octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+            self.load_profiles()
+
+    def get_matrix_folder(self):
+        return os.path.join(self.get_plugin_data_folder(), 'matrices')
+
+    # parse profiles from the settings if they changed and select the current profile
+    def load_profiles(self):
+        with self.profile_lock:
+            self.store.load(self._settings.get(['profiles']))
+            name = self._settings.get(['selected_profile'])
+            if name not in self.store.profiles:
+                # the UI saves the profiles before selecting another one when the selected profile is deleted
+                if 'disabled' not in self.store.profiles:
+                    return
+                name = 'disabled'
+            if (self.store.version, name) != self.profile_key:
+                self.profile_key = (self.store.version, name)
+                self.profiles = self.store.profiles
+                # save a reference to the selected profile for extra fast access
+                self.profile = self.profiles[name]
+                self.shared_mtime = None
+                self.load_shared()
+                self.update_mesh()
+
+    # replace the matrix of the selected profile with the shared one of its fixture if that changed
+    # returns True if the matrix was replaced
+    def load_shared(self):
+        fixture = self.profile.get('fixture_id')
+        if self.shared is None or not fixture:
+            return False
+        mtime = self.shared.mtime(fixture)
+        if mtime is None or mtime == self.shared_mtime:
+            return False
+        try:
+            result = self.shared.read(fixture)
+        except (IOError, OSError, ValueError) as e:
+            # keep the current matrix, and only warn again when the file changes
+            self.shared_mtime = mtime
+            self._logger.warning('Could not read shared matrix of fixture %s: %s' % (fixture, e))
+            return False
+        if result is None:
+            return False
+        self.profile['matrix'], self.shared_mtime = result
+        self.profile['matrix_updated'] = self.shared_mtime
+        self._logger.info('Loaded shared matrix of fixture %s' % fixture)
+        return True
+
+    # called regularly, switches to a matrix probed by another instance
+    def check_shared(self):
+        with self.profile_lock:
+            if self.load_shared():
+                self.update_mesh()
+                self.send_profile(self.profile)
     
     def get_api_commands(self):
         return dict(
-            probe_start = [], probe_cancel = [], profile_changed = []
+            probe_start = [], probe_cancel = [], profile_changed = [], stats_reset = [], prelevel = ['path']
         )
     
     def on_api_command(self, command, data):
@@ -77,242 +224,116 @@ class LevelAnythingPlugin(octoprint.plugin.SettingsPlugin,
             from flask import make_response
             return make_response('Insufficient permissions', 403)
         if command == 'probe_start':
-            self.profiles = json.loads(self._settings.get(['profiles']))
-            self.profile = self.profiles[self._settings.get(['selected_profile'])]
+            if self.probe_job is not None and self.probe_job.state == 'PROBING':
+                self._logger.info('Probing is already running')
+                return
+            self.load_profiles()
             self.set_status('PROBING', 'Probing started')
-            probe_thread = Thread(target = self.probe_start)
-            probe_thread.start()
+            self.probe_start()
         elif command == 'probe_cancel':
-            self.set_status('CANCEL', 'Probing cancelled, matrix not saved')
+            if self.probe_job is not None:
+                self.probe_job.cancel()
+            else:
+                self.set_status('CANCEL', 'Probing cancelled, matrix not saved')
+        elif command == 'stats_reset':
+            if self.stats is not None:
+                self.stats.reset()
         elif command == 'profile_changed':
-            self.profiles = json.loads(self._settings.get(['profiles']))
-            self.profile = self.profiles[self._settings.get(['selected_profile'])]
+            self.load_profiles()
+        elif command == 'prelevel':
+            # level a local file again, e.g. after probing a new matrix
+            Thread(target = self.prelevel_file, args = [data['path']]).start()
         else:
             self._logger.info('Unknown command %s' % command)
 
-    def probe_start(self):
-        if self.profile['safe_homing']:
-            # home first to prevent probe missing the bed
-            # if safe homing is disabled, the user must home the carriage
-            self.send_command('G28')
-
-        # calculate distance between probe points
-        dist_x = (self.profile['max_x'] - self.profile['min_x']) / float(self.profile['count_x'] - 1)
-        dist_y = (self.profile['max_y'] - self.profile['min_y']) / float(self.profile['count_y'] - 1)
-
-        # probe points and add to matrix
-        matrix = []
-        derivation = None
-        for y in range(0, self.profile['count_y']):
-            for x in range(0, self.profile['count_x']):
-                # abort if status changed while executing the last loop (error occured or user clicked cancel)
-                if self.status != 'PROBING':
-                    return
-                
-                cmd = []
-                # lift carriage if enabled
-                if self.profile['lift'] > 0:
-                    cmd.extend(['G91', 'G0 Z%.3f' % self.profile['lift']])
-
-                # get the coordinates we want to probe
-                point = [self.profile['min_x'] + dist_x * x, self.profile['min_y'] + dist_y * y, 0.0]
-                self.set_status('PROBING', 'Probing point %d of %d...' % (
-                    y * self.profile['count_x'] + x + 1, self.profile['count_x'] * self.profile['count_y']
-                ))
-                # send movement command and G30 to execute Z probe at position
-                cmd.extend([
-                    'G90',
-                    'G0 X%.3f Y%.3f F%.3f' % (
-                        point[0] + self.profile['offset_x'],
-                        point[1] + self.profile['offset_y'],
-                        self.profile['home_feed']
-                    ),
-                    'G30'
-                ])
-                if self._settings.get(['debug']):
-                    # fake G30 response on virtual printer
-                    cmd.append('!!DEBUG:send Bed X: %.3f Y: %.3f Z: %.3f' % (
-                        point[0] + self.profile['offset_x'],
-                        point[1] + self.profile['offset_y'],
-                        0.5
-                    ))
-                response = self.send_command(cmd, self.regex_probe)
-                if not response:
-                    self.set_status('ERROR', 'Probing at location %.3f, %.3f timed out' % (point[0], point[1]))
-                    return
+    def on_api_get(self, request):
+        if not user_permission.can():
+            return flask.make_response('Insufficient permissions', 403)
+        if 'matrix' in request.args:
+            return self.matrix_response(request.args['matrix'], request)
+        # the cache counts its hits itself, they are available without the statistics
+        return flask.jsonify(
+            stats = self.stats.to_dict() if self.stats is not None else None,
+            offset_cache = self.mesh.to_dict() if isinstance(self.mesh, CachedMesh) else None
+        )
 
-                # extract result from regex match
-                act_x = float(response.group(1)) - self.profile['offset_x']
-                act_y = float(response.group(2)) - self.profile['offset_y']
-                act_z = float(response.group(3))
-
-                # marlin ignores shifted coordinates (G92) for G30, adapt coordinate space dynamically
-                if derivation is None:
-                    derivation = [act_x - point[0], act_y - point[1]]
-                act_x, act_y = act_x - derivation[0], act_y - derivation[1]
-                # compare the points we want to the actual position reported by the printer
-                if not self.coords_equal(act_x, point[0], 0.1) or not self.coords_equal(act_y, point[1], 0.1):
-                    self.set_status('ERROR',
-                        'Probing failed: Coordinates mismatch, expected %.3f, %.3f, got %.3f, %.3f' %
-                        (point[0], point[1], act_x, act_y)
-                    )
-                    return
-                
-                # write z offset into matrix
-                point[2] = act_z
-
-                # send probe result to front-end
-                self.send_point(point)
-                matrix.append(point)
-        
-        # matrix is now populated, save in settings
-        self.profile['matrix'] = matrix
-        self.profile['matrix_updated'] = time()
-        self._settings.set(['profiles'], json.dumps(self.profiles))
-        self._settings.save()
+    # the matrix of a profile packed as float32 values, see pack_matrix
+    # the ETag changes with the matrix, so the UI only downloads it again after probing
+    def matrix_response(self, name, request):
+        profile = self.store.profiles.get(name)
+        if profile is None:
+            return flask.make_response('Unknown profile', 404)
+        etag = '"%r"' % float(profile['matrix_updated'])
+        if etag in request.headers.get('If-None-Match', ''):
+            response = flask.make_response('', 304)
+        else:
+            response = flask.make_response(pack_matrix(profile['matrix']))
+            response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def probe_start(self):
+        name = self._settings.get(['selected_profile'])
+        # probing runs in the background, results are processed when the printer sends them
+        timeout, debug = self._settings.get_float(['response_timeout']), self._settings.get_boolean(['debug'])
+        finish = lambda matrix: self.probe_finish(name, matrix)
+        if self.profile['probe_mode'] == 'adaptive':
+            self.probe_job = AdaptiveProbe(
+                self.profile, self.responses, timeout, debug, self._printer.commands, self.set_status, self.send_point, finish
+            )
+        else:
+            points = scattered_points(self.profile) if self.profile['probe_mode'] == 'scattered' else grid_points(self.profile)
+            if not points:
+                self.set_status('ERROR', 'Probing failed: No probe points configured')
+                return
+            self.probe_job = ProbeJob(
+                self.profile, points, self.responses, timeout, debug,
+                self._printer.commands, self.set_status, self.send_point, finish
+            )
+        # G29 starts probing from the queuing hook, don't send commands from within the hook
+        Thread(target = self.probe_job.start).start()
+
+    def probe_finish(self, name, matrix):
+        # points which were sampled repeatedly have their variance as fourth value, it's stored separately
+        variance = [[p[0], p[1], p[3]] for p in matrix if len(p) > 3]
+        matrix = [p[:3] for p in matrix]
+        # matrix is now populated, save it and the update time in settings
+        with self.profile_lock:
+            self._settings.set(['profiles'], self.store.save_matrix(name, matrix, time(), variance))
+            self._settings.save()
+            fixture = self.store.profiles[name].get('fixture_id')
+            if self.shared is not None and fixture:
+                # other instances using the same fixture load it from there
+                try:
+                    self.shared.write(fixture, matrix)
+                except (IOError, OSError) as e:
+                    self._logger.warning('Could not share matrix of fixture %s: %s' % (fixture, e))
+            self.load_profiles()
 
         # notify front-end with new data and status
         self.send_profile(self.profile)
-        self.set_status('IDLE', 'Probing finished')
-
-    # sends a command to the printer and waits for the specified response
-    def send_command(self, command, responseRegex = None):
-        if responseRegex is None:
-            self._printer.commands(command)
-            return None
-        self.command_event = Event()
-        self.command_regex = responseRegex
-        self._printer.commands(command)
-        result = self.command_event.wait(self._settings.get(['response_timeout']))
-        if result:
-            return self.command_match
+        if variance:
+            deviation = max(v[2] for v in variance) ** 0.5
+            self.set_status('IDLE', 'Probing finished, largest standard deviation %.4f mm' % deviation)
         else:
-            return None
-    
+            self.set_status('IDLE', 'Probing finished')
+
     def on_gcode_received(self, comm, line, *args, **kwargs):
-        if self.command_regex:
-            self.command_match = self.command_regex.search(line)
-            if self.command_match:
-                self.command_regex = None
-                self.command_event.set()
+        if self.responses.pending:
+            self.responses.on_line(line)
         return line
 
     def on_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+        if self.prelevel_refused and tags and 'source:file' in tags:
+            return (None, None)
+
         if not gcode:
             # we don't have a G-Code here, do nothing
             return cmd
 
-        # remove comment from command for processing
-        index = cmd.find(';')
-        comment = ''
-        if index != -1:
-            cmd = cmd[:index]
-            comment = cmd[index:]
-
-        # linear move
-        if gcode in ('G0', 'G00', 'G1', 'G01'):
-            # calculate z-offset at given position
-            # first get X/Y/Z-coordinates from command
-            # this is always executed for coordinate tracking
-            match = [r.search(cmd) for r in self.regex_coords]
-            target = []
-            for i in range(4):
-                if match[i]:
-                    if self.position_absolute:
-                        # absolute positioning, target position can be used directly
-                        target.append(float(match[i].group(1)))
-                    else:
-                        # relative positioning, target position is relative to old position
-                        target.append(self.position[i] + float(match[i].group(1)))
-                else:
-                    # if we don't have a new coordinate, the carriage stays at last coordinate
-                    target.append(self.position[i])
-            
-            if match[3] and self.position_absolute and not self.extruder_absolute:
-                # extruder uses relative coordinate override, correct here
-                if math.isnan(self.position[3]):
-                    target[3] = float(match[3].group(1))
-                else:
-                    target[3] = self.position[3] + float(match[3].group(1))
-
-            # check if we need to calculate a z-offset
-            if (len(self.profile['matrix']) == 0 or not self.position_absolute or
-                (self.profile['fade'] > 0 and target[2] > self.profile['fade']) or
-                True in [math.isnan(t) for t in target]):
-                # store move target as current X/Y/Z
-                self.position = target[:]
-                # we have no matrix, it's a relative movement, we are above fading height,
-                # or we don't have a valid target position; do nothing
-                return
-
-            # calculate move length, subdivide if necessary
-            commands = []
-            move_length = math.sqrt((self.position[0] - target[0]) ** 2 + (self.position[1] - target[1]) ** 2)
-            # self._logger.info('Move length: %.3f' % move_length)
-            if self.profile['divide'] > 0 and move_length > self.profile['divide']:
-                # move is longer than subdivision setting, split into smaller moves
-                factor = math.ceil(move_length / self.profile['divide'])
-                # calculate move lengths of segments per axis based on current position
-                lengths = [(target[i] - self.position[i]) / factor for i in range(len(target))]
-                for n in range(1, int(factor) + 1):
-                    move_point = [self.position[i] + lengths[i] * n for i in range(len(target))]
-                    move_point[2] += self.get_z_offset(move_point[0], move_point[1], move_point[2])
-                    commands.append(self.sub_coordinates(cmd, target, move_point))
-            else:
-                # modify with Z-offset
-                move_point = target[:]
-                move_point[2] += self.get_z_offset(move_point[0], move_point[1], move_point[2])
-                commands.append(self.sub_coordinates(cmd, target, move_point))
-
-            # store target as current X/Y/Z
-            self.position = target[:]
-            # return (divided) move
-            return commands
-
-        # home
-        elif gcode == 'G28':
-            # we don't know where the printer will move to, delete X/Y/Z
-            self.delete_position()
-
-            commands = []
-            # always set Z-offset when homing
-            commands.append('M851 Z%.3f' % self.profile['offset_z'])
-            if self.profile['safe_homing']:
-                if 'Z' not in cmd.upper() and ('X' in cmd.upper() or 'Y' in cmd.upper()):
-                    # command homes X or Y but not Z, do not modify
-                    commands.append(cmd + comment)
-                    return commands
-                # lift carriage if setting is positive
-                if self.profile['lift'] > 0:
-                    commands.extend([
-                        'G91', # relative coordinates
-                        'G0 Z%.3f F%.3f' % (self.profile['lift'], self.profile['lift_feed'])
-                    ])
-                # safe homing requires X and Y to be homed first
-                commands.append('G28 X Y')
-                # prepend movement command to Z-homing command
-                commands.extend([
-                    'G90', # absolute coordinates
-                    'G0 X%.3f Y%.3f F%.3f' % ( # move
-                        self.profile['home_x'] + self.profile['offset_x'],
-                        self.profile['home_y'] + self.profile['offset_y'],
-                        self.profile['home_feed']
-                    ),
-                    'G28 Z' # home Z
-                ])
-                if not self.position_absolute:
-                    # reset to relative positioning if it was set before
-                    commands.append('G91')
-
-                # return new homing sequence
-                return commands
-            else:
-                # no safe-homing required, just M851 and the original command
-                commands.append(cmd + comment)
-                return commands
-
         # auto level, use this plugin and suppress output to printer
-        elif gcode == 'G29':
+        if gcode == 'G29':
             self.on_api_command('probe_start', None)
             return (None, None)
 
@@ -320,6 +341,7 @@ class LevelAnythingPlugin(octoprint.plugin.SettingsPlugin,
         elif gcode == 'G42':
             # this is not used often (if at all), performance is not a problem
             # compile regex patterns here
+            cmd = cmd.split(';', 1)[0]
             matches = [
                 re.search('I([\d]+)', cmd, re.IGNORECASE),
                 re.search('J([\d]+)', cmd, re.IGNORECASE),
@@ -327,7 +349,10 @@ class LevelAnythingPlugin(octoprint.plugin.SettingsPlugin,
             ]
             values = [float(match.group(1)) if match else None for match in matches]
             if values[0] is not None and values[1] is not None:
-                index = int(values[1]) * int(self.profile['count_x']) + int(values[0])
+                # adaptive probing adds grid lines, use the size of the probed grid
+                # scattered points are a single row, addressed by I
+                count_x = self.mesh.count_x if self.mesh is not None else int(self.profile['count_x'])
+                index = int(values[1]) * count_x + int(values[0])
                 if index >= 0 and index < len(self.profile['matrix']):
                     return 'G0 X%.3f Y%.3f%s' % (
                         self.profile['matrix'][index][0],
@@ -336,141 +361,139 @@ class LevelAnythingPlugin(octoprint.plugin.SettingsPlugin,
                     )
             return (None, None)
 
-        # positioning mode: absolute
-        elif gcode == 'G90':
-            self.position_absolute = True
-
-        # positioning mode: relative
-        elif gcode == 'G91':
-            self.position_absolute = False
-        
-        # set X, Y, Z or E
-        elif gcode == 'G92':
-            match = [r.search(cmd) for r in self.regex_coords]
-            for i in range(4):
-                if match[i]:
-                    self.position[i] = float(match[i].group(1))
-
-        # extruder absolute
-        elif gcode == 'M82':
-            self.extruder_absolute = True
-
-        elif gcode == 'M83':
-            self.extruder_absolute = False
-
-    def get_z_offset(self, x, y, z):
-        # calculate surrounding matrix points
-        dist_x = (self.profile['max_x'] - self.profile['min_x']) / float(self.profile['count_x'] - 1)
-        dist_y = (self.profile['max_y'] - self.profile['min_y']) / float(self.profile['count_y'] - 1)
-        index_x = (x - self.profile['min_x']) / dist_x
-        index_y = (y - self.profile['min_y']) / dist_y
-        # find out where the point is relative to the matrix
-        index_nearby = []
-        if x < self.profile['min_x']:
-            if y < self.profile['min_y']:
-                # point is top left of matrix
-                index_nearby.append([0, 0])
-            elif y > self.profile['max_y']:
-                # point is bottom left of matrix
-                index_nearby.append([0, self.profile['count_y'] - 1])
-            else:
-                # point is left of matrix
-                index_nearby.append([0, math.floor(index_y)])
-                index_nearby.append([0, math.ceil(index_y)])
-        elif x > self.profile['max_x']:
-            if y < self.profile['min_y']:
-                # point is top right of matrix
-                index_nearby.append([self.profile['count_x'] - 1, 0])
-            elif y > self.profile['max_y']:
-                # point is bottom right of matrix
-                index_nearby.append([self.profile['count_x'] - 1, self.profile['count_y'] - 1])
-            else:
-                # point is right of matrix
-                index_nearby.append([self.profile['count_x'] - 1, math.floor(index_y)])
-                index_nearby.append([self.profile['count_x'] - 1, math.ceil(index_y)])
-        else:
-            if y < self.profile['min_y']:
-                # point is top of matrix
-                index_nearby.append([math.floor(index_x), 0])
-                index_nearby.append([math.ceil(index_x), 0])
-            elif y > self.profile['max_y']:
-                # point is bottom of matrix
-                index_nearby.append([math.floor(index_x), self.profile['count_y'] - 1])
-                index_nearby.append([math.ceil(index_x), self.profile['count_y'] - 1])
-            else:
-                # point is inside matrix, use all 4 nearby points
-                index_nearby = [
-                    [ math.floor(index_x), math.floor(index_y) ],
-                    [ math.ceil(index_x),  math.floor(index_y) ],
-                    [ math.floor(index_x), math.ceil(index_y)  ],
-                    [ math.ceil(index_x),  math.ceil(index_y)  ]
-                ]            
-
-        # get nearby points and their distance from our wanted point
-        points_nearby = []
-        for i in index_nearby:
-            point = self.profile['matrix'][int(i[1]) * int(self.profile['count_x']) + int(i[0])]
-            distance = math.sqrt((x - point[0]) ** 2 + (y - point[1]) ** 2)
-            points_nearby.append(point + [distance])
-
-        # calculate an average z-offset by distance from all found points
-        average_z = 0.0
-        total_distance = sum(p[3] for p in points_nearby)
-        exact_matches = [p for p in points_nearby if p[3] == 0]
-        if len(exact_matches) > 0:
-            # one distance is 0, which means point matches exactly, use its value directly
-            # and avoid division by zero in the else part
-            average_z = exact_matches[0][2]
+        # the file was already leveled before printing, send it as it is
+        elif self.prelevel_print:
+            return
+
+        # everything else is handled by the leveler
+        elif self.stats is None:
+            return self.leveler.process(cmd, gcode)
         else:
-            # no distance is 0, calculate percentage factor of distance, the closer the higher
-            total_factor = sum([total_distance / p[3] for p in points_nearby])
-            for p in points_nearby:
-                factor = total_distance / p[3] / total_factor
-                average_z += p[2] * factor
-
-        # apply fading height factor
-        if self.profile['fade'] > 0 and z > 0:
-            average_z *= 1 - z / self.profile['fade']
-
-        return average_z
-
-    def delete_position(self):
-        self.position = [float('nan'), float('nan'), float('nan'), 0.0]
-
-    # substitute coordinates in command with given values
-    def sub_coordinates(self, command, original_target, coordinates):
-        for i in range(4):
-            if original_target[i] == coordinates[i]:
-                # don't substitute already correct values
-                continue
-            match = self.regex_coords[i].search(command)
-            if match:
-                # coordinate match found, replace with new one
-                command = command[:match.start()] + (self.output[i] % coordinates[i]) + command[match.end():]
-            elif self.position[i] != coordinates[i]:
-                # append coordinate, but only if it's a different value than the current one
-                command = command + ' ' + (self.output[i] % coordinates[i])
-        return command
+            start = timer()
+            commands = self.leveler.process(cmd, gcode)
+            self.stats.add_line(timer() - start, commands)
+            return commands
+
+    # write a leveled copy of a local G-code file next to it, the original is kept to level it again later
+    # reads and writes line by line, so large files are no problem, runs on its own thread
+    def prelevel_file(self, path):
+        # level with a separate leveler, the file must not change the position of the printer
+        with self.profile_lock:
+            if self.mesh is None:
+                self._logger.info('No matrix, not leveling %s' % path)
+                return
+            leveler = Leveler(self.snapshot)
+            header = make_header(self._settings.get(['selected_profile']), self.profile['matrix_updated'], path)
+        target = leveled_path(path)
+        try:
+            with open(self._file_manager.path_on_disk('local', path), 'rb') as f:
+                if read_header(f.readline().decode('utf-8', 'replace')) is not None:
+                    # already leveled, the offset must not be applied twice
+                    self._logger.info('%s is already leveled' % path)
+                    return
+                f.seek(0)
+                self._file_manager.add_file(
+                    'local', target, StreamWrapper(os.path.basename(target), PrelevelStream(f, leveler, header)),
+                    allow_overwrite = True
+                )
+        except Exception:
+            self._logger.exception('Leveling %s failed' % path)
+            return
+        self._logger.info('Saved leveled copy of %s as %s' % (path, target))
+
+    def on_event(self, event, payload):
+        if event == Events.FILE_ADDED and payload.get('storage') == 'local':
+            path = payload.get('path', '')
+            if (self._settings.get_boolean(['prelevel_uploads']) and valid_file_type(path, type = 'gcode') and
+                not path.endswith(leveled_suffix)):
+                Thread(target = self.prelevel_file, args = [path]).start()
+        if event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+            self.prelevel_refused = False
+            if self.prelevel_print:
+                # position and modes weren't tracked while printing, the file may have left the printer relative
+                self.prelevel_print = False
+                self.leveler.delete_position()
+                self.leveler.reset_modes()
+
+    # the header of a pre-leveled file, queued from the same thread right before the first line of the file
+    # the print started event arrives asynchronously, too late to keep the first moves from being leveled again
+    def on_atcommand_queuing(self, comm_instance, phase, command, parameters, tags = None, *args, **kwargs):
+        if command != header_command or (tags and 'source:file' not in tags):
+            return
+        header = parse_header(parameters)
+        if header is None:
+            return
+        if (header.get('profile') != self._settings.get(['selected_profile']) or
+            header.get('matrix_updated') != self.profile['matrix_updated']):
+            # neither the stale offsets nor leveling them a second time would print right, refuse the file
+            self._logger.warning('File was pre-leveled with profile %s from %s, not with the current matrix' % (
+                header.get('profile'), header.get('matrix_updated')
+            ))
+            self.prelevel_refused = True
+            text = 'Print cancelled, the file was leveled with an outdated matrix.'
+            if header.get('source'):
+                text += ' Leveling %s again, start the print once the new copy is saved.' % header['source']
+                Thread(target = self.prelevel_file, args = [header['source']]).start()
+            self._plugin_manager.send_plugin_message(self._identifier, dict(warning = text))
+            # don't cancel from within the hook, the printer connection is in the middle of sending the file
+            Thread(target = self._printer.cancel_print).start()
+            return
+        self._logger.info('Printing pre-leveled file, live leveling disabled')
+        self.prelevel_print = True
+
+    # rebuild the interpolation mesh, must be called whenever the matrix or the selected profile changes
+    # only called while holding profile_lock
+    def update_mesh(self):
+        self.mesh = mesh_from_profile(self.profile)
+        if self.mesh is None and len(self.profile.get('matrix', [])) > 0:
+            self._logger.warning('Matrix does not match the configured probe grid, leveling disabled until probed again')
+        resolution = self._settings.get_float(['offset_cache_resolution'])
+        if self.mesh is not None and resolution > 0:
+            self.mesh = CachedMesh(self.mesh, resolution, self._settings.get_int(['offset_cache_size']))
+        if self.stats is not None:
+            self.stats.offset_cache = self.mesh if isinstance(self.mesh, CachedMesh) else None
+        # the leveler only sees complete profiles, the new one is used from the next command on
+        self.snapshot = ProfileSnapshot(self.profile, self.mesh)
+        self.leveler.snapshot = self.snapshot
 
     # set the status variable and send change to front-end
     def set_status(self, status, text):
+        if status != 'PROBING':
+            # the UI must have all points before probing ends
+            self.send_points()
         self.status = status
         self._plugin_manager.send_plugin_message(self._identifier, dict(status = status, text = text))
     
-    # send a measured point to the UI
+    # queue a measured point for the UI, points probed in quick succession are sent in a single message
     def send_point(self, point):
+        with self.points_lock:
+            self.points.append(point)
+            if self.points_timer is None:
+                self.points_timer = Timer(self.point_interval, self.send_points)
+                self.points_timer.daemon = True
+                self.points_timer.start()
+
+    # send all queued points to the UI
+    def send_points(self):
+        with self.points_lock:
+            points, self.points = self.points, []
+            if self.points_timer is not None:
+                self.points_timer.cancel()
+                self.points_timer = None
+        if points:
+            self._plugin_manager.send_plugin_message(self._identifier, dict(points = points))
+
+    # send the queuing hook statistics to the UI
+    def send_stats(self):
+        self._plugin_manager.send_plugin_message(self._identifier, dict(stats = self.stats.to_dict()))
+
+    # send a changed profile to the UI, without its matrix which is requested separately if it changed
+    def send_profile(self, profile):
+        self.send_points()
         self._plugin_manager.send_plugin_message(
-            self._identifier,
-            dict(point = point)
+            self._identifier, dict(profile = dict(profile, matrix = [], matrix_variance = []))
         )
-
-    def send_profile(self, profile):
-        self._plugin_manager.send_plugin_message(self._identifier, dict(profile = profile))
     
-    # compares two coordinates for equality with the given tolerance
-    def coords_equal(self, float1, float2, tolerance = 0.1):
-        return abs(float1 - float2) < tolerance
-
     def get_assets(self):
         return dict(
             js = ['js/levelanything.js'],
@@ -512,4 +535,5 @@ def __plugin_load__():
         'octoprint.plugin.softwareupdate.check_config': __plugin_implementation__.get_update_information,
         'octoprint.comm.protocol.gcode.received': __plugin_implementation__.on_gcode_received,
         'octoprint.comm.protocol.gcode.queuing': __plugin_implementation__.on_gcode_queuing,
+        'octoprint.comm.protocol.atcommand.queuing': __plugin_implementation__.on_atcommand_queuing,
     }
@@ -0,0 +1,156 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re
+
+# the usual layout of a move written by slicers, matched in a single pass
+# G0/G1, optional feed rate, X, Y, Z, E in this order (each optional), optional feed rate
+regex_move = re.compile(
+    '[Gg]0?[01]'
+    '(?:[ \t]*[Ff][\d\.]+)?'
+    '(?:[ \t]*[Xx]([\-\d\.]+))?'
+    '(?:[ \t]*[Yy]([\-\d\.]+))?'
+    '(?:[ \t]*[Zz]([\-\d\.]+))?'
+    '(?:[ \t]*[Ee]([\-\d\.]+))?'
+    '(?:[ \t]*[Ff][\d\.]+)?'
+    '[ \t]*$'
+)
+# any single word, used for commands not matching the layout above
+regex_word = re.compile('([A-Za-z])[ \t]*([\-\d\.]*)')
+# position in the coordinate lists used by the plugin, X/Y/Z/E
+axis_index = dict(X = 0, Y = 1, Z = 2, E = 3, x = 0, y = 1, z = 2, e = 3)
+output = [' X%.3f', ' Y%.3f', ' Z%.3f', ' E%.3f']
+# formats of the X/Y/Z/E values replaced in a command
+value_formats = ('%.3f', '%.3f', '%.3f', '%.3f')
+# relative extrusion of divided moves is written with more decimals, the rounding errors of the segments add up
+relative_formats = ('%.3f', '%.3f', '%.3f', '%.5f')
+axis_order = (0, 1, 2, 3)
+
+# a parsed G-code line, one instance is reused for every line passing the hook
+# text: command without comment
+# coords: X/Y/Z/E value as float, None if not present
+# spans: position of the X/Y/Z/E value in text, (-1, -1) if not present
+# comment: comment including the semicolon, empty if there is none
+class GcodeLine(object):
+    __slots__ = ('text', 'comment', 'coords', 'spans', 'order')
+
+    def __init__(self, line = None):
+        self.text = self.comment = ''
+        self.coords = [None, None, None, None]
+        self.spans = [(-1, -1)] * 4
+        self.order = axis_order
+        if line is not None:
+            self.parse(line)
+
+    def parse(self, line):
+        # split off the comment
+        index = line.find(';')
+        if index != -1:
+            self.comment = line[index:]
+            line = line[:index].rstrip()
+        else:
+            self.comment = ''
+        self.text = line
+
+        match = regex_move.match(line)
+        if match:
+            x, y, z, e = match.groups()
+            self.coords = [x and float(x), y and float(y), z and float(z), e and float(e)]
+            self.spans = match.regs[1:]
+            self.order = axis_order
+        else:
+            # uncommon layout, e.g. additional words or unusual order
+            coords = self.coords = [None, None, None, None]
+            spans = self.spans = [(-1, -1)] * 4
+            for word in regex_word.finditer(line):
+                i = axis_index.get(word.group(1))
+                # words without a value (e.g. G28 X) don't define a coordinate
+                if i is not None and word.group(2):
+                    coords[i] = float(word.group(2))
+                    spans[i] = word.span(2)
+            self.order = sorted(axis_order, key = lambda i: spans[i][0])
+        return self
+
+    # build the command with the given coordinates from the parsed record, without scanning the text again
+    # unchanged coordinates keep their original formatting, missing coordinates are only
+    # appended if they differ from the current position
+    def format(self, original_target, coordinates, position, formats = value_formats):
+        text = self.text
+        spans = self.spans
+        result = tail = ''
+        last = 0
+        for i in self.order:
+            value = coordinates[i]
+            if original_target[i] != value:
+                start, end = spans[i]
+                if start != -1:
+                    result += text[last:start] + formats[i] % value
+                    last = end
+                elif position[i] != value:
+                    tail += output[i] % value
+        return result + text[last:] + tail
+
+    # %-format template with a placeholder for each of the given axes, for formatting many segments of one move at once
+    # returns the template and the axes in the order of their placeholders
+    def template(self, axes, formats = value_formats):
+        text = self.text
+        spans = self.spans
+        result = tail = ''
+        last = 0
+        order = []
+        missing = []
+        for i in self.order:
+            if i in axes:
+                start, end = spans[i]
+                if start != -1:
+                    result += text[last:start].replace('%', '%%') + formats[i]
+                    last = end
+                    order.append(i)
+                else:
+                    tail += output[i]
+                    missing.append(i)
+        return result + text[last:].replace('%', '%%') + tail, order + missing
+
+# letters of the words only used by arcs: center offset, radius, number of full circles and feed rate
+arc_letters = 'IiJjRrPpFf'
+
+# I/J/R/P/F values of an arc command as floats, keyed by upper case letter
+def arc_words(text):
+    return dict(
+        (word.group(1).upper(), float(word.group(2)))
+        for word in regex_word.finditer(text) if word.group(1) in arc_letters and word.group(2)
+    )
+
+# number with the given decimals, without trailing zeros
+def trim(value, decimals):
+    text = '%.*f' % (decimals, value)
+    text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+# short moves to the given points, each [x, y, z, e] with e None without extrusion
+# only values which differ from the previous point after rounding are written, previous is the point before the first,
+# values of it which are None are always written
+# relative extrusion is written as the difference to the total written so far, so the rounding errors don't add up
+def format_compact(word, points, previous, relative):
+    commands = []
+    last = [trim(v, 3) if v is not None else None for v in previous[:3]]
+    extruded = previous[3]
+    for point in points:
+        command = word
+        for i in range(3):
+            value = trim(point[i], 3)
+            if value != last[i]:
+                command += ' ' + 'XYZ'[i] + value
+                last[i] = value
+        e = point[3]
+        if e is not None:
+            if relative:
+                e = round(e - extruded, 5)
+                if e != 0:
+                    command += ' E' + trim(e, 5)
+                    extruded += e
+            elif trim(e, 5) != trim(extruded, 5):
+                command += ' E' + trim(e, 5)
+                extruded = e
+        if command != word:
+            commands.append(command)
+    return commands
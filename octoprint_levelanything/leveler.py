@@ -0,0 +1,583 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from .gcode import GcodeLine, arc_words, format_compact, regex_move, relative_formats, value_formats
+from timeit import default_timer as timer
+import math
+
+# numpy is optional, without it long moves are divided in the plain loop
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# moves with at least this many segments are divided in a single batch if numpy is available
+batch_segments = 16
+
+# end points to keep from points with the given leveled z (the first is the start of the move), so that the z of all
+# points in between stays within the tolerance of the straight line between the kept ones, and at most limit points
+# are merged into one move
+# the slopes from the last kept point allowed by all points since then form a window, which only gets narrower
+def coalesce(zs, tolerance, limit):
+    keep = []
+    start = 0
+    low, high = float('-inf'), float('inf')
+    for n in range(1, len(zs)):
+        slope = (zs[n] - zs[start]) / (n - start)
+        if n - start > limit or slope < low or slope > high:
+            # the previous point is the last one reachable in a straight line
+            keep.append(n - 1)
+            start = n - 1
+            low, high = float('-inf'), float('inf')
+        low = max(low, (zs[n] - tolerance - zs[start]) / (n - start))
+        high = min(high, (zs[n] + tolerance - zs[start]) / (n - start))
+    keep.append(len(zs) - 1)
+    return keep
+
+# extrusion of each segment of a divided move with relative extrusion e, the segments end at the given fractions of
+# the move, the last one at 1
+# each segment extrudes the difference of the totals rounded like they are written (see relative_formats), so the
+# written values add up to the extrusion of the whole move
+def split_extrusion(e, fractions):
+    result = []
+    last = 0.0
+    for fraction in fractions:
+        total = round(e * fraction, 5)
+        result.append(total - last)
+        last = total
+    return result
+
+# tracks the carriage position through a stream of commands and rewrites moves with the z-offset of the mesh
+# used for the commands sent to the printer as well as for pre-leveling files, each stream has its own instance
+class Leveler(object):
+
+    # snapshot is a ProfileSnapshot, it's replaced when the profile changes
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.position = [float('nan'), float('nan'), float('nan'), 0.0]
+        self.position_absolute = True
+        self.extruder_absolute = True
+        # arcs are only divided in the X/Y plane (G17)
+        self.plane_xy = True
+        # the snapshot the last move went above the fading height with, moves are only tracked while it's set
+        self.faded = None
+        # the last command with each coordinate (by index) while faded, parsed only when the position is needed
+        self.faded_moves = dict()
+        self.line = GcodeLine()
+        # HookStats instance if interpolation time should be measured
+        self.stats = None
+
+    # process a single command, returns None if it should be sent unmodified or a list of commands to send instead
+    def process(self, cmd, gcode):
+        # the same snapshot is used for the whole command, even if it's replaced meanwhile
+        snapshot = self.snapshot
+        # linear move
+        if gcode in ('G0', 'G00', 'G1', 'G01'):
+            # above the fading height nothing is leveled until Z goes down, only the position is tracked
+            if self.faded is snapshot:
+                # most moves don't change Z, with absolute extrusion it's enough to remember the last command with
+                # each coordinate, lower case words would be missed and comments might contain the letters
+                if self.extruder_absolute and cmd.isupper() and 'Z' not in cmd and ';' not in cmd:
+                    moves = self.faded_moves
+                    if 'X' in cmd:
+                        moves[0] = cmd
+                    if 'Y' in cmd:
+                        moves[1] = cmd
+                    if 'E' in cmd:
+                        moves[3] = cmd
+                    return
+                # otherwise only update the coordinates in the command,
+                # anything not matching the usual layout is processed completely
+                self.apply_faded_moves()
+                index = cmd.find(';')
+                match = regex_move.match(cmd if index == -1 else cmd[:index].rstrip())
+                if match:
+                    x, y, z, e = match.groups()
+                    if z is None or float(z) > snapshot.fade:
+                        position = self.position
+                        if x:
+                            position[0] = float(x)
+                        if y:
+                            position[1] = float(y)
+                        if z:
+                            position[2] = float(z)
+                        if e:
+                            if self.extruder_absolute or math.isnan(position[3]):
+                                position[3] = float(e)
+                            else:
+                                position[3] += float(e)
+                        return
+                self.faded = None
+            elif self.faded is not None:
+                self.unfade()
+
+            # calculate z-offset at given position
+            # first get X/Y/Z-coordinates from command, parsed in a single pass
+            # this is always executed for coordinate tracking
+            line = self.line.parse(cmd)
+            target = self.get_target(line.coords)
+
+            # check if we need to calculate a z-offset
+            if (snapshot.mesh is None or not self.position_absolute or
+                (snapshot.fade > 0 and target[2] > snapshot.fade) or
+                True in [math.isnan(t) for t in target]):
+                # store move target as current X/Y/Z
+                self.position = target[:]
+                if self.position_absolute and snapshot.fade > 0 and target[2] > snapshot.fade:
+                    self.faded = snapshot
+                # we have no matrix, it's a relative movement, we are above fading height,
+                # or we don't have a valid target position; do nothing
+                return
+
+            # calculate move length, subdivide if necessary
+            commands = []
+            move_length = math.sqrt((self.position[0] - target[0]) ** 2 + (self.position[1] - target[1]) ** 2)
+            if (snapshot.divide > 0 and move_length > snapshot.divide and snapshot.divide_tolerance > 0 and
+                (target[2] == self.position[2] or not snapshot.fade_inv)):
+                # move is longer than subdivision setting, only split where the surface requires it
+                # with fading, the offset isn't a parabola between grid lines if Z changes, that's divided evenly
+                commands = self.subdivide_adaptive(snapshot, line, target)
+            elif snapshot.divide > 0 and move_length > snapshot.divide:
+                # move is longer than subdivision setting, split into smaller moves
+                factor = int(math.ceil(move_length / snapshot.divide))
+                if snapshot.coalesce_tolerance > 0:
+                    commands = self.subdivide_coalesced(snapshot, line, gcode, target, factor)
+                elif numpy is not None and factor >= batch_segments:
+                    commands = self.subdivide_batch(snapshot, line, target, factor)
+                else:
+                    # calculate move lengths of segments per axis based on current position
+                    lengths = [(target[i] - self.position[i]) / factor for i in range(len(target))]
+                    original, extrusion, formats = self.segment_extrusion(
+                        line, target, [n / factor for n in range(1, factor + 1)]
+                    )
+                    for n in range(1, factor + 1):
+                        move_point = [self.position[i] + lengths[i] * n for i in range(len(target))]
+                        move_point[2] += self.get_z_offset(snapshot, move_point[0], move_point[1], move_point[2])
+                        if extrusion is not None:
+                            move_point[3] = extrusion[n - 1]
+                        commands.append(line.format(original, move_point, self.position, formats))
+            else:
+                # modify with Z-offset
+                move_point = target[:]
+                move_point[2] += self.get_z_offset(snapshot, move_point[0], move_point[1], move_point[2])
+                commands.append(line.format(target, move_point, self.position))
+
+            # store target as current X/Y/Z
+            self.position = target[:]
+            # return (divided) move
+            return commands
+
+        # arc, replaced by leveled linear moves
+        if gcode in ('G2', 'G02', 'G3', 'G03'):
+            self.unfade()
+            return self.process_arc(snapshot, cmd, gcode in ('G2', 'G02'))
+
+        # remove comment from command for processing
+        index = cmd.find(';')
+        comment = ''
+        if index != -1:
+            comment = cmd[index:]
+            cmd = cmd[:index]
+
+        # home
+        if gcode == 'G28':
+            # we don't know where the printer will move to, delete X/Y/Z
+            self.delete_position()
+
+            commands = []
+            # always set Z-offset when homing
+            commands.append(snapshot.offset_command)
+            if snapshot.safe_homing:
+                if 'Z' not in cmd.upper() and ('X' in cmd.upper() or 'Y' in cmd.upper()):
+                    # command homes X or Y but not Z, do not modify
+                    commands.append(cmd + comment)
+                    return commands
+                # lift carriage if setting is positive
+                if snapshot.lift > 0:
+                    commands.extend([
+                        'G91', # relative coordinates
+                        snapshot.lift_command
+                    ])
+                # safe homing requires X and Y to be homed first
+                commands.append('G28 X Y')
+                # prepend movement command to Z-homing command
+                commands.extend([
+                    'G90', # absolute coordinates
+                    snapshot.home_command, # move
+                    'G28 Z' # home Z
+                ])
+                if not self.position_absolute:
+                    # reset to relative positioning if it was set before
+                    commands.append('G91')
+
+                # return new homing sequence
+                return commands
+            else:
+                # no safe-homing required, just M851 and the original command
+                commands.append(cmd + comment)
+                return commands
+
+        # positioning mode: absolute
+        elif gcode == 'G90':
+            self.position_absolute = True
+
+        # positioning mode: relative
+        elif gcode == 'G91':
+            self.unfade()
+            self.position_absolute = False
+
+        # set X, Y, Z or E
+        elif gcode == 'G92':
+            self.unfade()
+            coords = self.line.parse(cmd).coords
+            for i in range(4):
+                if coords[i] is not None:
+                    self.position[i] = coords[i]
+
+        # arc plane
+        elif gcode in ('G17', 'G18', 'G19'):
+            self.plane_xy = gcode == 'G17'
+
+        # extruder absolute
+        elif gcode == 'M82':
+            self.extruder_absolute = True
+
+        elif gcode == 'M83':
+            # the remembered commands have absolute E
+            self.unfade()
+            self.extruder_absolute = False
+
+    # target position of a move from its parsed X/Y/Z/E coordinates
+    def get_target(self, coords):
+        target = []
+        for i in range(4):
+            if coords[i] is not None:
+                if self.position_absolute:
+                    # absolute positioning, target position can be used directly
+                    target.append(coords[i])
+                else:
+                    # relative positioning, target position is relative to old position
+                    target.append(self.position[i] + coords[i])
+            else:
+                # if we don't have a new coordinate, the carriage stays at last coordinate
+                target.append(self.position[i])
+
+        if coords[3] is not None and self.position_absolute and not self.extruder_absolute:
+            # extruder uses relative coordinate override, correct here
+            if math.isnan(self.position[3]):
+                target[3] = coords[3]
+            else:
+                target[3] = self.position[3] + coords[3]
+        return target
+
+    # G2 (clockwise) and G3 (counter-clockwise) arcs are divided into linear moves short enough to stay within
+    # the arc tolerance, and each of them gets the z-offset of its end point
+    # the end point is tracked in any case, arcs that can't be leveled are sent unmodified
+    def process_arc(self, snapshot, cmd, clockwise):
+        line = self.line.parse(cmd)
+        position = self.position
+        target = self.get_target(line.coords)
+        self.position = target[:]
+        if (snapshot.mesh is None or snapshot.arc_tolerance <= 0 or not self.position_absolute or not self.plane_xy or
+            (snapshot.fade > 0 and target[2] > snapshot.fade) or
+            True in [math.isnan(v) for v in position[:3] + target]):
+            return
+
+        words = arc_words(line.text)
+        x0, y0, x1, y1 = position[0], position[1], target[0], target[1]
+        if 'R' in words:
+            # center on the perpendicular bisector of start and end, a negative radius selects the longer arc
+            radius = words['R']
+            dx, dy = x1 - x0, y1 - y0
+            distance = math.sqrt(dx * dx + dy * dy)
+            if radius == 0 or distance == 0:
+                return
+            h = math.sqrt(max(radius * radius - distance * distance / 4, 0.0)) / distance
+            if clockwise != (radius < 0):
+                h = -h
+            cx, cy = (x0 + x1) / 2 - dy * h, (y0 + y1) / 2 + dx * h
+        elif 'I' in words or 'J' in words:
+            # center relative to the start point
+            cx, cy = x0 + words.get('I', 0.0), y0 + words.get('J', 0.0)
+        else:
+            return
+
+        # swept angle in the same way as the firmware, the same start and end point is a full circle
+        r0 = math.sqrt((x0 - cx) ** 2 + (y0 - cy) ** 2)
+        r1 = math.sqrt((x1 - cx) ** 2 + (y1 - cy) ** 2)
+        if r0 == 0:
+            return
+        start = math.atan2(y0 - cy, x0 - cx)
+        sweep = math.atan2(y1 - cy, x1 - cx) - start
+        if sweep < 0:
+            sweep += 2 * math.pi
+        if clockwise:
+            sweep -= 2 * math.pi
+        elif sweep == 0:
+            sweep = 2 * math.pi
+        # P adds full circles
+        sweep += 2 * math.pi * int(words.get('P', 0)) * (-1 if clockwise else 1)
+
+        # largest angle of a chord staying within the tolerance, the tolerance applies to the larger radius
+        radius = max(r0, r1)
+        tolerance = snapshot.arc_tolerance
+        step = 2 * math.acos(1 - tolerance / radius) if tolerance < radius else math.pi
+        segments = int(math.ceil(abs(sweep) / min(step, math.pi / 2)))
+        if snapshot.divide > 0:
+            segments = max(segments, int(math.ceil(abs(sweep) * radius / snapshot.divide)))
+
+        # E of segment n is e0 + de * n, relative extrusion starts at 0
+        extrude = line.coords[3] is not None
+        relative = extrude and not self.extruder_absolute
+        if relative:
+            e0, de = 0.0, line.coords[3] / segments
+        else:
+            e0, de = position[3], (target[3] - position[3]) / segments
+
+        # end points of all segments, the last one ends exactly at the target
+        if numpy is not None and segments >= batch_segments:
+            # all segments are interpolated at once
+            t = numpy.arange(1, segments + 1) / segments
+            radii = r0 + (r1 - r0) * t
+            xs, ys = cx + radii * numpy.cos(start + sweep * t), cy + radii * numpy.sin(start + sweep * t)
+            xs[-1], ys[-1] = x1, y1
+            zs = position[2] + (target[2] - position[2]) * t
+            zs = zs + self.get_z_offsets(snapshot, xs, ys, zs, segments)
+            xs, ys, zs = xs.tolist(), ys.tolist(), zs.tolist()
+        else:
+            xs, ys, zs = [], [], []
+            # rotate the radius vector by a fixed angle instead of calculating sine and cosine for every segment
+            cos_step, sin_step = math.cos(sweep / segments), math.sin(sweep / segments)
+            ux, uy = (x0 - cx) / r0, (y0 - cy) / r0
+            dz = (target[2] - position[2]) / segments
+            for n in range(1, segments):
+                ux, uy = ux * cos_step - uy * sin_step, ux * sin_step + uy * cos_step
+                r = r0 + (r1 - r0) * n / segments
+                x, y, z = cx + ux * r, cy + uy * r, position[2] + dz * n
+                xs.append(x)
+                ys.append(y)
+                zs.append(z + self.get_z_offset(snapshot, x, y, z))
+            xs.append(x1)
+            ys.append(y1)
+            zs.append(target[2] + self.get_z_offset(snapshot, x1, y1, target[2]))
+        es = [e0 + de * n for n in range(1, segments + 1)] if extrude else None
+
+        if snapshot.coalesce_tolerance > 0:
+            # merging segments must not exceed the arc tolerance, only segments shortened by the divide length can be merged
+            limit = max(int(min(step, math.pi / 2) * segments / abs(sweep)), 1)
+            start_z = position[2] + self.get_z_offset(snapshot, x0, y0, position[2])
+            keep = coalesce([start_z] + zs, snapshot.coalesce_tolerance, limit)
+            points = [(xs[n - 1], ys[n - 1], zs[n - 1], es[n - 1] if extrude else None) for n in keep]
+            # Z is always written, the printer might not be at the leveled start position
+            commands = format_compact('G1', points, [x0, y0, None, 0.0 if relative else position[3]], relative)
+        else:
+            # E is written with more precision, relative extrusion is the difference to the previous segment
+            # after rounding, so the rounding errors don't add up
+            template = 'G1 X%.3f Y%.3f Z%.3f'
+            columns = [xs, ys, zs]
+            if relative:
+                columns.append([round(e, 5) - round(p, 5) for p, e in zip([0.0] + es, es)])
+            elif extrude:
+                columns.append(es)
+            if extrude:
+                template += ' E%.5f'
+            values = [v for point in zip(*columns) for v in point]
+            commands = ((template + '\n') * segments % tuple(values)).split('\n')[:-1]
+
+        if 'F' in words:
+            commands[0] += ' F%.3f' % words['F']
+        return commands
+
+    # faded z-offsets for arrays of points, the interpolation time is added to the statistics as count points
+    def get_z_offsets(self, snapshot, xs, ys, zs, count):
+        if self.stats is not None:
+            start = timer()
+            offsets = snapshot.mesh.offsets(xs, ys)
+            self.stats.add_interpolation(timer() - start, count)
+        else:
+            offsets = snapshot.mesh.offsets(xs, ys)
+        if snapshot.fade > 0:
+            offsets *= numpy.where(zs > 0, 1 - zs * snapshot.fade_inv, 1.0)
+        return offsets
+
+    # divide into segments of equal length like the subdivision loop, then merge segments where the z-offset is
+    # close enough to a straight line, the first segment keeps all words of the original command,
+    # all following ones only contain the words that change
+    def subdivide_coalesced(self, snapshot, line, gcode, target, factor):
+        position = self.position
+        if numpy is not None and factor >= batch_segments:
+            n = numpy.arange(1, factor + 1)
+            points = [position[i] + (target[i] - position[i]) / factor * n for i in range(3)]
+            zs = (points[2] + self.get_z_offsets(snapshot, points[0], points[1], points[2], factor)).tolist()
+        else:
+            zs = []
+            for n in range(1, factor + 1):
+                move_point = [position[i] + (target[i] - position[i]) / factor * n for i in range(3)]
+                zs.append(move_point[2] + self.get_z_offset(snapshot, move_point[0], move_point[1], move_point[2]))
+        start_z = position[2] + self.get_z_offset(snapshot, position[0], position[1], position[2])
+        keep = coalesce([start_z] + zs, snapshot.coalesce_tolerance, factor)
+
+        # relative extrusion is split between the kept segments, E counts from 0 for this move
+        relative = line.coords[3] is not None and not self.extruder_absolute
+        original = target[:]
+        e0, e1 = position[3], target[3]
+        if relative:
+            e0, e1 = 0.0, line.coords[3]
+            original[3] = e1
+        points = []
+        for n in keep:
+            move_point = [position[i] + (target[i] - position[i]) * n / factor for i in range(2)]
+            points.append(move_point + [zs[n - 1], e0 + (e1 - e0) * n / factor])
+        points[-1][:2] = target[:2]
+        points[-1][3] = e1
+
+        first = points[0]
+        if relative:
+            # the first segment writes E with 3 decimals, the next ones continue from the rounded value
+            first[3] = round(first[3], 3) if len(points) > 1 else e1
+        commands = [line.format(original, first, [position[0], position[1], position[2], e0])]
+        if line.coords[3] is None:
+            for point in points:
+                point[3] = None
+        return commands + format_compact(gcode, points[1:], first, relative)
+
+    # same as the subdivision loop, but all segments are interpolated and formatted at once
+    def subdivide_batch(self, snapshot, line, target, factor):
+        position = self.position
+        n = numpy.arange(1, factor)
+        points = [position[i] + (target[i] - position[i]) / factor * n for i in range(4)]
+        points[2] = points[2] + self.get_z_offsets(snapshot, points[0], points[1], points[2], factor - 1)
+
+        original, extrusion, formats = self.segment_extrusion(line, target, [k / factor for k in range(1, factor + 1)])
+        if extrusion is not None:
+            points[3] = extrusion[:-1]
+
+        # axes that don't move keep their original value, Z always changes
+        template, order = line.template([i for i in range(4) if i == 2 or target[i] != position[i]], formats)
+        values = numpy.column_stack([points[i] for i in order]).ravel().tolist()
+        commands = ((template + '\n') * (factor - 1) % tuple(values)).split('\n')
+        # the last segment ends at the original target, formatted like a single move
+        move_point = target[:]
+        move_point[2] += self.get_z_offset(snapshot, move_point[0], move_point[1], move_point[2])
+        if extrusion is not None:
+            move_point[3] = extrusion[-1]
+        commands[-1] = line.format(original, move_point, position, formats)
+        return commands
+
+    # with relative extrusion, segments of a divided move get their share of the extrusion instead of the position
+    # returns the target as written in the command, the extrusion of each segment (None for absolute extrusion)
+    # and the formats to write the segments with
+    def segment_extrusion(self, line, target, fractions):
+        if line.coords[3] is None or self.extruder_absolute:
+            return target, None, value_formats
+        original = target[:]
+        original[3] = line.coords[3]
+        return original, split_extrusion(line.coords[3], fractions), relative_formats
+
+    # divide a move only where the z-offset deviates more than the tolerance from a straight line
+    # between the crossings of the mesh, the offset along the move is a polynomial of at most second degree, which is
+    # known exactly from three samples, so the deviation of any straight segment from it can be calculated
+    def subdivide_adaptive(self, snapshot, line, target):
+        position = self.position
+        tolerance = snapshot.divide_tolerance
+        delta = [target[i] - position[i] for i in range(4)]
+        offset = lambda t: self.get_z_offset(
+            snapshot, position[0] + delta[0] * t, position[1] + delta[1] * t, position[2] + delta[2] * t
+        )
+
+        # pieces as (start, length, c0, c1, c2), the offset is c0 + c1 * u + c2 * u² with u from 0 to 1 on the piece
+        # possible segment ends are the ends of the pieces, pieces deviating too much from their chord are split into
+        # equal parts first, the deviation is largest in the middle and shrinks with the square of the length
+        # ends are (position along move, offset, piece)
+        bounds = [0.0] + snapshot.mesh.crossings(position[0], position[1], target[0], target[1]) + [1.0]
+        ends = [(0.0, offset(0.0), None)]
+        for a, b in zip(bounds, bounds[1:]):
+            if b - a < 1e-9:
+                continue
+            za, zm, zb = ends[-1][1], offset((a + b) / 2), offset(b)
+            piece = (a, b - a, za, 4 * zm - 3 * za - zb, 2 * za + 2 * zb - 4 * zm)
+            parts = max(int(math.ceil(math.sqrt(abs(piece[4]) / 4 / tolerance))), 1)
+            for k in range(1, parts):
+                u = k / parts
+                ends.append((a + (b - a) * u, piece[2] + piece[3] * u + piece[4] * u * u, piece))
+            ends.append((b, zb, piece))
+
+        # extend each segment as long as it stays within the tolerance on all pieces it covers
+        # a single part always fits, so every segment ends after its start
+        keep = []
+        start = 0
+        for n in range(2, len(ends)):
+            if not self.segment_fits(ends, start, n, tolerance):
+                keep.append(n - 1)
+                start = n - 1
+        keep.append(len(ends) - 1)
+
+        original, extrusion, formats = self.segment_extrusion(line, target, [ends[n][0] for n in keep])
+        commands = []
+        for k, n in enumerate(keep):
+            t, z = ends[n][0], ends[n][1]
+            if n == len(ends) - 1:
+                # the last segment ends exactly at the target
+                move_point = target[:]
+            else:
+                move_point = [position[i] + delta[i] * t for i in range(4)]
+            move_point[2] += z
+            if extrusion is not None:
+                move_point[3] = extrusion[k]
+            commands.append(line.format(original, move_point, position, formats))
+        return commands
+
+    # whether the straight segment between two ends deviates at most tolerance from the pieces in between
+    def segment_fits(self, ends, start, end, tolerance):
+        t0, z0 = ends[start][0], ends[start][1]
+        slope = (ends[end][1] - z0) / (ends[end][0] - t0)
+        for n in range(start + 1, end + 1):
+            a, length, c0, c1, c2 = ends[n][2]
+            # difference of the piece and the segment as polynomial in u, checked at both ends and its extremum
+            d0 = c0 - z0 - slope * (a - t0)
+            d1 = c1 - slope * length
+            u0, u1 = (ends[n - 1][0] - a) / length, (ends[n][0] - a) / length
+            us = [u0, u1]
+            if c2 != 0 and u0 < -d1 / (2 * c2) < u1:
+                us.append(-d1 / (2 * c2))
+            if any(abs(d0 + d1 * u + c2 * u * u) > tolerance for u in us):
+                return False
+        return True
+
+    def get_z_offset(self, snapshot, x, y, z):
+        # interpolate z-offset from the precomputed mesh
+        if self.stats is not None:
+            start = timer()
+            average_z = snapshot.mesh.offset(x, y)
+            self.stats.add_interpolation(timer() - start)
+        else:
+            average_z = snapshot.mesh.offset(x, y)
+
+        # apply fading height factor
+        if snapshot.fade_inv and z > 0:
+            average_z *= 1 - z * snapshot.fade_inv
+
+        return average_z
+
+    # leave the faded state, the position is updated from the remembered commands
+    def unfade(self):
+        self.apply_faded_moves()
+        self.faded = None
+
+    def apply_faded_moves(self):
+        if self.faded_moves:
+            for i, cmd in self.faded_moves.items():
+                value = self.line.parse(cmd).coords[i]
+                if value is not None:
+                    self.position[i] = value
+            self.faded_moves = dict()
+
+    def delete_position(self):
+        self.position = [float('nan'), float('nan'), float('nan'), 0.0]
+        self.faded = None
+        self.faded_moves = dict()
+
+    # back to the modes the printer starts with, for when the commands setting them weren't seen
+    def reset_modes(self):
+        self.position_absolute = True
+        self.extruder_absolute = True
+        self.plane_xy = True
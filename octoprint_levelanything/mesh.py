@@ -0,0 +1,681 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from .probing import scattered_points
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import math
+
+# numpy is optional, it's only used to process many points at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# mesh for the profile's matrix, None if there is no usable matrix
+def mesh_from_profile(profile):
+    if profile.get('probe_mode') == 'adaptive':
+        return RectMesh.from_profile(profile)
+    elif profile.get('probe_mode') == 'scattered':
+        return ScatterMesh.from_profile(profile)
+    elif profile.get('interpolation', 'bilinear') != 'bilinear':
+        return CubicGridMesh.from_profile(profile, profile['interpolation'])
+    return GridMesh.from_profile(profile)
+
+# a regular probe grid, preprocessed once per matrix update
+# lookups are plain arithmetic on flat lists, no searching or allocation of intermediate lists
+class GridMesh(object):
+    __slots__ = (
+        'count_x', 'count_y', 'min_x', 'min_y', 'dist_x', 'dist_y', 'inv_x', 'inv_y',
+        'cells_x', 'cells_y', 'max_u', 'max_v', 'z', 'coeffs', 'coeff_array'
+    )
+    # highest degree of the offset along a straight line between its crossings, adaptive subdivision needs at most 2
+    line_degree = 2
+
+    def __init__(self, min_x, min_y, max_x, max_y, count_x, count_y, z):
+        self.count_x = int(count_x)
+        self.count_y = int(count_y)
+        self.min_x = float(min_x)
+        self.min_y = float(min_y)
+        # spacing between probe points and its reciprocal, a single row/column has no spacing
+        self.dist_x = (float(max_x) - self.min_x) / (self.count_x - 1) if self.count_x > 1 else 0.0
+        self.dist_y = (float(max_y) - self.min_y) / (self.count_y - 1) if self.count_y > 1 else 0.0
+        self.inv_x = 1.0 / self.dist_x if self.dist_x else 0.0
+        self.inv_y = 1.0 / self.dist_y if self.dist_y else 0.0
+        # number of cells and the highest valid grid coordinate per axis
+        self.cells_x = max(self.count_x - 1, 1)
+        self.cells_y = max(self.count_y - 1, 1)
+        self.max_u = float(self.count_x - 1)
+        self.max_v = float(self.count_y - 1)
+        self.z = [float(v) for v in z]
+
+        # bilinear coefficients per cell, z = a + b * u + c * v + d * u * v
+        # with u, v being the position inside the cell from 0 to 1
+        coeffs = []
+        for j in range(self.cells_y):
+            row0 = j * self.count_x
+            row1 = min(j + 1, self.count_y - 1) * self.count_x
+            for i in range(self.cells_x):
+                i1 = min(i + 1, self.count_x - 1)
+                z00, z10 = self.z[row0 + i], self.z[row0 + i1]
+                z01, z11 = self.z[row1 + i], self.z[row1 + i1]
+                coeffs.extend((z00, z10 - z00, z01 - z00, z00 - z10 - z01 + z11))
+        self.coeffs = coeffs
+        # same coefficients as one row per cell for batched lookups
+        self.coeff_array = numpy.array(coeffs, dtype = float).reshape(-1, 4) if numpy is not None else None
+
+    # creates a mesh from a profile dict, returns None if the matrix can't be used
+    # additional arguments are passed to the constructor
+    @classmethod
+    def from_profile(cls, profile, *args):
+        matrix = profile.get('matrix') or []
+        count_x, count_y = int(profile['count_x']), int(profile['count_y'])
+        if len(matrix) == 0 or len(matrix) != count_x * count_y:
+            # no matrix yet, or the grid size was changed after probing
+            return None
+        return cls(
+            profile['min_x'], profile['min_y'], profile['max_x'], profile['max_y'],
+            count_x, count_y, [p[2] for p in matrix], *args
+        )
+
+    # interpolated z-offset at the given position, points outside the grid use the nearest edge
+    def offset(self, x, y):
+        u = (x - self.min_x) * self.inv_x
+        if u <= 0.0:
+            i, u = 0, 0.0
+        elif u >= self.max_u:
+            i = self.cells_x - 1
+            u = self.max_u - i
+        else:
+            i = int(u)
+            u -= i
+        v = (y - self.min_y) * self.inv_y
+        if v <= 0.0:
+            j, v = 0, 0.0
+        elif v >= self.max_v:
+            j = self.cells_y - 1
+            v = self.max_v - j
+        else:
+            j = int(v)
+            v -= j
+        c = self.coeffs
+        k = (j * self.cells_x + i) * 4
+        return c[k] + c[k + 1] * u + (c[k + 2] + c[k + 3] * u) * v
+
+    # interpolated z-offsets for many positions at once, returns a numpy array if numpy is available
+    def offsets(self, x, y):
+        if numpy is None:
+            return [self.offset(x[n], y[n]) for n in range(len(x))]
+        u = numpy.clip((numpy.asarray(x, dtype = float) - self.min_x) * self.inv_x, 0.0, self.max_u)
+        v = numpy.clip((numpy.asarray(y, dtype = float) - self.min_y) * self.inv_y, 0.0, self.max_v)
+        # points on the last grid line belong to the last cell
+        i = numpy.minimum(u.astype(int), self.cells_x - 1)
+        j = numpy.minimum(v.astype(int), self.cells_y - 1)
+        u -= i
+        v -= j
+        c = self.coeff_array[j * self.cells_x + i]
+        return c[:, 0] + c[:, 1] * u + (c[:, 2] + c[:, 3] * u) * v
+
+    # positions along the line from (x0, y0) to (x1, y1), from 0 to 1, where it crosses a grid line
+    # the interpolation is smooth between these positions, but has a kink on them
+    def crossings(self, x0, y0, x1, y1):
+        result = []
+        for p0, p1, start, dist, count in (
+            (x0, x1, self.min_x, self.dist_x, self.count_x),
+            (y0, y1, self.min_y, self.dist_y, self.count_y)
+        ):
+            if p0 == p1 or not dist:
+                continue
+            # grid coordinates of both ends, the outer grid lines are included because the edges are clamped
+            a, b = (p0 - start) / dist, (p1 - start) / dist
+            first = max(int(math.floor(min(a, b))) + 1, 0)
+            last = min(int(math.ceil(max(a, b))) - 1, count - 1)
+            for k in range(first, last + 1):
+                result.append((start + k * dist - p0) / (p1 - p0))
+        result.sort()
+        return result
+
+# hermite basis, turns values and slopes at both ends of a cell into polynomial coefficients
+hermite = ((1, 0, 0, 0), (0, 0, 1, 0), (-3, 3, -2, -1), (2, -2, 1, 1))
+
+# maximum number of probe points for the thin-plate spline, larger grids use the slopes from the neighbors
+# solving the spline takes cubic time, which is a lot slower without numpy
+spline_max_points = 400 if numpy is not None else 100
+
+# a regular probe grid with a smooth (C1) surface, every cell is a bicubic polynomial through its corners
+# the slopes at the probe points are estimated from their neighbors (bicubic), or taken from a thin-plate spline
+# through all points (spline), which follows the overall shape of the surface more closely
+# only the coefficients differ, lookups are the same fixed polynomial evaluation for both
+class CubicGridMesh(GridMesh):
+    __slots__ = ()
+    # bicubic in x and y, so up to sixth degree along a diagonal
+    line_degree = 6
+
+    def __init__(self, min_x, min_y, max_x, max_y, count_x, count_y, z, interpolation = 'bicubic'):
+        GridMesh.__init__(self, min_x, min_y, max_x, max_y, count_x, count_y, z)
+        # slopes per probe point in grid units
+        slopes = None
+        if interpolation == 'spline' and self.count_x > 1 and self.count_y > 1 and len(self.z) <= spline_max_points:
+            slopes = self.spline_slopes()
+        if slopes is None:
+            slopes = self.neighbor_slopes()
+        su, sv, suv = slopes
+
+        # 16 coefficients per cell, z = sum of a[i][j] * u^i * v^j, stored as a[0][0], a[0][1], ... a[3][3]
+        coeffs = []
+        for j in range(self.cells_y):
+            j1 = min(j + 1, self.count_y - 1)
+            for i in range(self.cells_x):
+                i1 = min(i + 1, self.count_x - 1)
+                k00, k10 = j * self.count_x + i, j * self.count_x + i1
+                k01, k11 = j1 * self.count_x + i, j1 * self.count_x + i1
+                f = (
+                    (self.z[k00], self.z[k01], sv[k00], sv[k01]),
+                    (self.z[k10], self.z[k11], sv[k10], sv[k11]),
+                    (su[k00], su[k01], suv[k00], suv[k01]),
+                    (su[k10], su[k11], suv[k10], suv[k11])
+                )
+                # a = H * f * H^T
+                hf = [[sum(hermite[r][n] * f[n][c] for n in range(4)) for c in range(4)] for r in range(4)]
+                coeffs.extend(sum(hf[r][n] * hermite[c][n] for n in range(4)) for r in range(4) for c in range(4))
+        self.coeffs = coeffs
+        self.coeff_array = numpy.array(coeffs, dtype = float).reshape(-1, 16) if numpy is not None else None
+
+    # central differences, one-sided at the edges of the grid
+    def neighbor_slopes(self):
+        z, count_x, count_y = self.z, self.count_x, self.count_y
+        su, sv, suv = [], [], []
+        for j in range(count_y):
+            j0, j1 = max(j - 1, 0), min(j + 1, count_y - 1)
+            for i in range(count_x):
+                i0, i1 = max(i - 1, 0), min(i + 1, count_x - 1)
+                su.append((z[j * count_x + i1] - z[j * count_x + i0]) / (i1 - i0) if i1 > i0 else 0.0)
+                sv.append((z[j1 * count_x + i] - z[j0 * count_x + i]) / (j1 - j0) if j1 > j0 else 0.0)
+                suv.append((
+                    z[j1 * count_x + i1] - z[j1 * count_x + i0] - z[j0 * count_x + i1] + z[j0 * count_x + i0]
+                ) / ((i1 - i0) * (j1 - j0)) if i1 > i0 and j1 > j0 else 0.0)
+        return su, sv, suv
+
+    # derivatives of the thin-plate spline through all probe points, z = a + b * x + c * y + sum of w * r² * log(r)
+    # the spline is computed in grid units, so the derivatives don't have to be scaled
+    def spline_slopes(self):
+        points = [(i, j) for j in range(self.count_y) for i in range(self.count_x)]
+        n = len(points)
+        kernel = lambda d2: 0.5 * d2 * math.log(d2) if d2 > 0 else 0.0
+        matrix = [[0.0] * (n + 3) for r in range(n + 3)]
+        for r, (x0, y0) in enumerate(points):
+            for c, (x1, y1) in enumerate(points):
+                matrix[r][c] = kernel((x0 - x1) ** 2 + (y0 - y1) ** 2)
+            matrix[r][n:] = [1.0, x0, y0]
+            matrix[n][r], matrix[n + 1][r], matrix[n + 2][r] = 1.0, x0, y0
+        weights = solve(matrix, self.z + [0.0, 0.0, 0.0])
+
+        # derivatives of r² log r: d/dx = dx * (2 log r + 1), d²/dxdy = 2 * dx * dy / r²
+        su, sv, suv = [], [], []
+        for x0, y0 in points:
+            du, dv, duv = weights[n + 1], weights[n + 2], 0.0
+            for w, (x1, y1) in zip(weights, points):
+                dx, dy = x0 - x1, y0 - y1
+                d2 = dx * dx + dy * dy
+                if d2 > 0:
+                    factor = w * (math.log(d2) + 1)
+                    du += factor * dx
+                    dv += factor * dy
+                    duv += w * 2 * dx * dy / d2
+            su.append(du)
+            sv.append(dv)
+            suv.append(duv)
+        return su, sv, suv
+
+    # interpolated z-offset at the given position, points outside the grid use the nearest edge
+    def offset(self, x, y):
+        u = (x - self.min_x) * self.inv_x
+        if u <= 0.0:
+            i, u = 0, 0.0
+        elif u >= self.max_u:
+            i = self.cells_x - 1
+            u = self.max_u - i
+        else:
+            i = int(u)
+            u -= i
+        v = (y - self.min_y) * self.inv_y
+        if v <= 0.0:
+            j, v = 0, 0.0
+        elif v >= self.max_v:
+            j = self.cells_y - 1
+            v = self.max_v - j
+        else:
+            j = int(v)
+            v -= j
+        c = self.coeffs
+        k = (j * self.cells_x + i) * 16
+        return (
+            c[k] + v * (c[k + 1] + v * (c[k + 2] + v * c[k + 3])) +
+            u * (c[k + 4] + v * (c[k + 5] + v * (c[k + 6] + v * c[k + 7])) +
+            u * (c[k + 8] + v * (c[k + 9] + v * (c[k + 10] + v * c[k + 11])) +
+            u * (c[k + 12] + v * (c[k + 13] + v * (c[k + 14] + v * c[k + 15])))))
+        )
+
+    # interpolated z-offsets for many positions at once, returns a numpy array if numpy is available
+    def offsets(self, x, y):
+        if numpy is None:
+            return [self.offset(x[n], y[n]) for n in range(len(x))]
+        u = numpy.clip((numpy.asarray(x, dtype = float) - self.min_x) * self.inv_x, 0.0, self.max_u)
+        v = numpy.clip((numpy.asarray(y, dtype = float) - self.min_y) * self.inv_y, 0.0, self.max_v)
+        i = numpy.minimum(u.astype(int), self.cells_x - 1)
+        j = numpy.minimum(v.astype(int), self.cells_y - 1)
+        u -= i
+        v -= j
+        c = self.coeff_array[j * self.cells_x + i]
+        result = numpy.zeros(len(u))
+        for r in range(3, -1, -1):
+            result = result * u + c[:, 4 * r] + v * (c[:, 4 * r + 1] + v * (c[:, 4 * r + 2] + v * c[:, 4 * r + 3]))
+        return result
+
+# solves a linear system, with numpy if available, otherwise by gaussian elimination
+def solve(matrix, rhs):
+    if numpy is not None:
+        return numpy.linalg.solve(numpy.array(matrix), numpy.array(rhs)).tolist()
+    n = len(rhs)
+    rows = [list(matrix[r]) + [rhs[r]] for r in range(n)]
+    for c in range(n):
+        pivot = max(range(c, n), key = lambda r: abs(rows[r][c]))
+        rows[c], rows[pivot] = rows[pivot], rows[c]
+        for r in range(c + 1, n):
+            factor = rows[r][c] / rows[c][c]
+            if factor:
+                row, top = rows[r], rows[c]
+                for k in range(c, n + 1):
+                    row[k] -= factor * top[k]
+    result = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        result[r] = (rows[r][n] - sum(rows[r][k] * result[k] for k in range(r + 1, n))) / rows[r][r]
+    return result
+
+# a grid with unequally spaced lines, as created by adaptive probing
+# cells are found by bisecting the line positions, the interpolation is the same as on a regular grid
+class RectMesh(object):
+    __slots__ = (
+        'xs', 'ys', 'count_x', 'count_y', 'inv_x', 'inv_y', 'cells_x', 'cells_y', 'z', 'coeffs',
+        'coeff_array', 'x_array', 'y_array', 'inv_x_array', 'inv_y_array'
+    )
+    line_degree = 2
+
+    def __init__(self, xs, ys, z):
+        self.xs = [float(v) for v in xs]
+        self.ys = [float(v) for v in ys]
+        self.count_x = len(self.xs)
+        self.count_y = len(self.ys)
+        # reciprocal width of every cell, a single row/column has no width
+        self.inv_x = [1.0 / (self.xs[i + 1] - self.xs[i]) for i in range(self.count_x - 1)] or [0.0]
+        self.inv_y = [1.0 / (self.ys[j + 1] - self.ys[j]) for j in range(self.count_y - 1)] or [0.0]
+        self.cells_x = len(self.inv_x)
+        self.cells_y = len(self.inv_y)
+        self.z = [float(v) for v in z]
+
+        # bilinear coefficients per cell, same layout as GridMesh
+        coeffs = []
+        for j in range(self.cells_y):
+            row0 = j * self.count_x
+            row1 = min(j + 1, self.count_y - 1) * self.count_x
+            for i in range(self.cells_x):
+                i1 = min(i + 1, self.count_x - 1)
+                z00, z10 = self.z[row0 + i], self.z[row0 + i1]
+                z01, z11 = self.z[row1 + i], self.z[row1 + i1]
+                coeffs.extend((z00, z10 - z00, z01 - z00, z00 - z10 - z01 + z11))
+        self.coeffs = coeffs
+        if numpy is not None:
+            self.coeff_array = numpy.array(coeffs, dtype = float).reshape(-1, 4)
+            self.x_array = numpy.array(self.xs)
+            self.y_array = numpy.array(self.ys)
+            self.inv_x_array = numpy.array(self.inv_x)
+            self.inv_y_array = numpy.array(self.inv_y)
+        else:
+            self.coeff_array = self.x_array = self.y_array = self.inv_x_array = self.inv_y_array = None
+
+    # creates a mesh from a profile dict, returns None if the matrix isn't a complete grid covering the probe area
+    @classmethod
+    def from_profile(cls, profile):
+        matrix = profile.get('matrix') or []
+        if len(matrix) == 0:
+            return None
+        xs = sorted(set(p[0] for p in matrix))
+        ys = sorted(set(p[1] for p in matrix))
+        if len(matrix) != len(xs) * len(ys):
+            return None
+        # points must be stored row by row, and the area must not have changed after probing
+        for n, p in enumerate(matrix):
+            if p[0] != xs[n % len(xs)] or p[1] != ys[n // len(xs)]:
+                return None
+        for value, limit in ((xs[0], 'min_x'), (xs[-1], 'max_x'), (ys[0], 'min_y'), (ys[-1], 'max_y')):
+            if abs(value - float(profile[limit])) > 1e-6:
+                return None
+        return cls(xs, ys, [p[2] for p in matrix])
+
+    # interpolated z-offset at the given position, points outside the grid use the nearest edge
+    def offset(self, x, y):
+        xs = self.xs
+        if x <= xs[0]:
+            i, u = 0, 0.0
+        elif x >= xs[-1]:
+            i, u = self.cells_x - 1, 1.0
+        else:
+            i = bisect_right(xs, x) - 1
+            u = (x - xs[i]) * self.inv_x[i]
+        ys = self.ys
+        if y <= ys[0]:
+            j, v = 0, 0.0
+        elif y >= ys[-1]:
+            j, v = self.cells_y - 1, 1.0
+        else:
+            j = bisect_right(ys, y) - 1
+            v = (y - ys[j]) * self.inv_y[j]
+        c = self.coeffs
+        k = (j * self.cells_x + i) * 4
+        return c[k] + c[k + 1] * u + (c[k + 2] + c[k + 3] * u) * v
+
+    # interpolated z-offsets for many positions at once, returns a numpy array if numpy is available
+    def offsets(self, x, y):
+        if numpy is None:
+            return [self.offset(x[n], y[n]) for n in range(len(x))]
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+        i = numpy.clip(numpy.searchsorted(self.x_array, x, 'right') - 1, 0, self.cells_x - 1)
+        j = numpy.clip(numpy.searchsorted(self.y_array, y, 'right') - 1, 0, self.cells_y - 1)
+        u = numpy.clip((x - self.x_array[i]) * self.inv_x_array[i], 0.0, 1.0)
+        v = numpy.clip((y - self.y_array[j]) * self.inv_y_array[j], 0.0, 1.0)
+        c = self.coeff_array[j * self.cells_x + i]
+        return c[:, 0] + c[:, 1] * u + (c[:, 2] + c[:, 3] * u) * v
+
+    # positions along the line from (x0, y0) to (x1, y1), from 0 to 1, where it crosses a grid line
+    def crossings(self, x0, y0, x1, y1):
+        result = []
+        for p0, p1, lines in ((x0, x1, self.xs), (y0, y1, self.ys)):
+            if p0 == p1:
+                continue
+            low, high = min(p0, p1), max(p0, p1)
+            for k in range(bisect_right(lines, low), bisect_left(lines, high)):
+                result.append((lines[k] - p0) / (p1 - p0))
+        result.sort()
+        return result
+
+# delaunay triangulation of a list of (x, y) by inserting one point after another (bowyer-watson)
+# returns triangles as triples of point indices, takes quadratic time, which is fine for a few hundred probe points
+def delaunay(points):
+    n = len(points)
+    min_x, max_x = min(p[0] for p in points), max(p[0] for p in points)
+    min_y, max_y = min(p[1] for p in points), max(p[1] for p in points)
+    size = max(max_x - min_x, max_y - min_y, 1.0) * 1000
+    mid_x, mid_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+    # a triangle containing all points, removed again at the end
+    # it has to be very large, otherwise triangles at the border are missing if the points there are almost on a line
+    vertices = list(points) + [(mid_x - size, mid_y - size), (mid_x + size, mid_y - size), (mid_x, mid_y + size)]
+
+    def circumcircle(t):
+        (ax, ay), (bx, by), (cx, cy) = vertices[t[0]], vertices[t[1]], vertices[t[2]]
+        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        if d == 0:
+            return (t, 0.0, 0.0, -1.0)
+        ux = ((ax * ax + ay * ay) * (by - cy) + (bx * bx + by * by) * (cy - ay) + (cx * cx + cy * cy) * (ay - by)) / d
+        uy = ((ax * ax + ay * ay) * (cx - bx) + (bx * bx + by * by) * (ax - cx) + (cx * cx + cy * cy) * (bx - ax)) / d
+        return (t, ux, uy, (ax - ux) ** 2 + (ay - uy) ** 2)
+
+    triangles = [circumcircle((n, n + 1, n + 2))]
+    for k in range(n):
+        x, y = vertices[k]
+        bad, good = [], []
+        for c in triangles:
+            (bad if (x - c[1]) ** 2 + (y - c[2]) ** 2 < c[3] * (1 - 1e-12) else good).append(c)
+        # the outline of the removed triangles is connected to the new point
+        edges = dict()
+        for c in bad:
+            t = c[0]
+            for a, b in ((t[0], t[1]), (t[1], t[2]), (t[2], t[0])):
+                key = (min(a, b), max(a, b))
+                edges[key] = None if key in edges else (a, b)
+        triangles = good + [circumcircle((e[0], e[1], k)) for e in edges.values() if e is not None]
+    return [c[0] for c in triangles if max(c[0]) < n]
+
+# arbitrary probe points, triangulated once per matrix update
+# inside the triangulation the offset is linear on every triangle, outside the nearest point on its border is used
+# triangles are found through a grid of buckets over the probed area, each listing the triangles overlapping it
+class ScatterMesh(object):
+    __slots__ = (
+        'count_x', 'min_x', 'min_y', 'max_x', 'max_y', 'buckets_x', 'buckets_y', 'inv_x', 'inv_y',
+        'coeffs', 'buckets', 'bucket_edges', 'edges', 'border', 'coeff_array', 'bucket_array', 'last'
+    )
+    # tolerance of the inside test, so points on an edge are found in either triangle
+    epsilon = 1e-9
+    line_degree = 1
+
+    def __init__(self, points, z, triangles):
+        # G42 addresses the probe points with I, in the order they were entered
+        self.count_x = len(points)
+        self.min_x, self.max_x = min(p[0] for p in points), max(p[0] for p in points)
+        self.min_y, self.max_y = min(p[1] for p in points), max(p[1] for p in points)
+        width, height = self.max_x - self.min_x, self.max_y - self.min_y
+        # about one bucket per triangle
+        side = math.sqrt(width * height / len(triangles))
+        self.buckets_x = max(int(math.ceil(width / side)), 1)
+        self.buckets_y = max(int(math.ceil(height / side)), 1)
+        self.inv_x = self.buckets_x / width
+        self.inv_y = self.buckets_y / height
+
+        # per triangle: first corner, inverse of the edge matrix for barycentric coordinates, and the plane
+        # z = a + b * x + c * y
+        coeffs = []
+        for t in triangles:
+            (x0, y0), (x1, y1), (x2, y2) = points[t[0]], points[t[1]], points[t[2]]
+            z0, z1, z2 = z[t[0]], z[t[1]], z[t[2]]
+            det = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+            b = ((y2 - y0) * (z1 - z0) - (y1 - y0) * (z2 - z0)) / det
+            c = ((x1 - x0) * (z2 - z0) - (x2 - x0) * (z1 - z0)) / det
+            coeffs.append((
+                x0, y0, (y2 - y0) / det, -(x2 - x0) / det, -(y1 - y0) / det, (x1 - x0) / det,
+                z0 - b * x0 - c * y0, b, c
+            ))
+        self.coeffs = coeffs
+        # consecutive moves are close to each other, the triangle found last is tested first
+        self.last = coeffs[0]
+
+        # all edges as (x0, y0, x1, y1), the border is made of edges belonging to a single triangle
+        count = dict()
+        for t in triangles:
+            for a, b in ((t[0], t[1]), (t[1], t[2]), (t[2], t[0])):
+                key = (min(a, b), max(a, b))
+                count[key] = count.get(key, 0) + 1
+        self.edges = [points[a] + points[b] for a, b in count]
+        # border edges as (x0, y0, dx, dy, 1 / length², z0, dz)
+        self.border = [
+            (points[a][0], points[a][1], points[b][0] - points[a][0], points[b][1] - points[a][1],
+             1.0 / ((points[b][0] - points[a][0]) ** 2 + (points[b][1] - points[a][1]) ** 2), z[a], z[b] - z[a])
+            for (a, b), c in count.items() if c == 1
+        ]
+
+        # triangle numbers per bucket, and the coefficients of these triangles to loop over them directly
+        triangle_buckets = [[] for n in range(self.buckets_x * self.buckets_y)]
+        self.bucket_edges = [[] for n in range(self.buckets_x * self.buckets_y)]
+        for n, t in enumerate(triangles):
+            for bucket in self.bucket_range([points[k][0] for k in t], [points[k][1] for k in t]):
+                triangle_buckets[bucket].append(n)
+        for n, e in enumerate(self.edges):
+            for bucket in self.bucket_range((e[0], e[2]), (e[1], e[3])):
+                self.bucket_edges[bucket].append(n)
+        self.buckets = [tuple(coeffs[n] for n in b) for b in triangle_buckets]
+
+        if numpy is not None:
+            # one row per coefficient, so each can be gathered for many triangles at once
+            self.coeff_array = numpy.array(coeffs, dtype = float).T.copy()
+            # triangles per bucket padded to the same length with -1
+            width = max(len(b) for b in triangle_buckets)
+            self.bucket_array = numpy.array([b + [-1] * (width - len(b)) for b in triangle_buckets])
+        else:
+            self.coeff_array = self.bucket_array = None
+
+    # creates a mesh from a profile dict, returns None if the points can't be triangulated
+    @classmethod
+    def from_profile(cls, profile):
+        matrix = profile.get('matrix') or []
+        wanted = [(p[1], p[2]) for p in scattered_points(profile)]
+        if len(matrix) == 0 or [(p[0], p[1]) for p in matrix] != wanted:
+            # no matrix yet, or the points were changed after probing
+            return None
+        points = [(float(p[0]), float(p[1])) for p in matrix]
+        z = [float(p[2]) for p in matrix]
+        # duplicate points would create empty triangles, the first one is used
+        unique = dict()
+        for n, p in enumerate(points):
+            unique.setdefault(p, n)
+        indices = sorted(unique.values())
+        if len(indices) < 3:
+            return None
+        triangles = delaunay([points[n] for n in indices])
+        if not triangles:
+            # all points on a single line
+            return None
+        mesh = cls([points[n] for n in indices], [z[n] for n in indices], triangles)
+        mesh.count_x = len(points)
+        return mesh
+
+    # indices of the buckets overlapping the bounding box of the given coordinates
+    def bucket_range(self, xs, ys):
+        i0 = min(max(int((min(xs) - self.min_x) * self.inv_x), 0), self.buckets_x - 1)
+        i1 = min(max(int((max(xs) - self.min_x) * self.inv_x), 0), self.buckets_x - 1)
+        j0 = min(max(int((min(ys) - self.min_y) * self.inv_y), 0), self.buckets_y - 1)
+        j1 = min(max(int((max(ys) - self.min_y) * self.inv_y), 0), self.buckets_y - 1)
+        return [j * self.buckets_x + i for j in range(j0, j1 + 1) for i in range(i0, i1 + 1)]
+
+    # interpolated z-offset at the given position
+    def offset(self, x, y):
+        e = -self.epsilon
+        x0, y0, m00, m01, m10, m11, a, b, c = self.last
+        dx, dy = x - x0, y - y0
+        l1 = m00 * dx + m01 * dy
+        l2 = m10 * dx + m11 * dy
+        if l1 >= e and l2 >= e and l1 + l2 <= 1 - e:
+            return a + b * x + c * y
+        if self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y:
+            i = min(int((x - self.min_x) * self.inv_x), self.buckets_x - 1)
+            j = min(int((y - self.min_y) * self.inv_y), self.buckets_y - 1)
+            for triangle in self.buckets[j * self.buckets_x + i]:
+                x0, y0, m00, m01, m10, m11, a, b, c = triangle
+                dx, dy = x - x0, y - y0
+                l1 = m00 * dx + m01 * dy
+                if l1 < e:
+                    continue
+                l2 = m10 * dx + m11 * dy
+                if l2 >= e and l1 + l2 <= 1 - e:
+                    self.last = triangle
+                    return a + b * x + c * y
+        return self.outside(x, y)
+
+    # offset of the nearest point on the border of the triangulation
+    def outside(self, x, y):
+        nearest, result = float('inf'), 0.0
+        for x0, y0, dx, dy, inv, z0, dz in self.border:
+            ox, oy = x - x0, y - y0
+            t = (ox * dx + oy * dy) * inv
+            if t <= 0.0:
+                distance = ox * ox + oy * oy
+                t = 0.0
+            elif t >= 1.0:
+                ox, oy = ox - dx, oy - dy
+                distance = ox * ox + oy * oy
+                t = 1.0
+            else:
+                ox, oy = ox - dx * t, oy - dy * t
+                distance = ox * ox + oy * oy
+            if distance < nearest:
+                nearest, result = distance, z0 + dz * t
+        return result
+
+    # interpolated z-offsets for many positions at once, returns a numpy array if numpy is available
+    def offsets(self, x, y):
+        if numpy is None:
+            return [self.offset(x[n], y[n]) for n in range(len(x))]
+        x = numpy.asarray(x, dtype = float)
+        y = numpy.asarray(y, dtype = float)
+        i = numpy.clip(((x - self.min_x) * self.inv_x).astype(int), 0, self.buckets_x - 1)
+        j = numpy.clip(((y - self.min_y) * self.inv_y).astype(int), 0, self.buckets_y - 1)
+        # test all triangles of each point's bucket, the first one containing the point is used
+        candidates = self.bucket_array[j * self.buckets_x + i]
+        c = self.coeff_array
+        dx, dy = x[:, None] - c[0][candidates], y[:, None] - c[1][candidates]
+        l1 = c[2][candidates] * dx + c[3][candidates] * dy
+        l2 = c[4][candidates] * dx + c[5][candidates] * dy
+        e = -self.epsilon
+        inside = (candidates >= 0) & (l1 >= e) & (l2 >= e) & (l1 + l2 <= 1 - e)
+        found = inside.any(axis = 1)
+        triangle = candidates[numpy.arange(len(x)), inside.argmax(axis = 1)]
+        result = c[6][triangle] + c[7][triangle] * x + c[8][triangle] * y
+        for n in numpy.nonzero(~found)[0]:
+            result[n] = self.outside(x[n], y[n])
+        return result
+
+    # positions along the line from (x0, y0) to (x1, y1), from 0 to 1, where the interpolation has a kink
+    def crossings(self, x0, y0, x1, y1):
+        edges = set()
+        for bucket in self.bucket_range((x0, x1), (y0, y1)):
+            edges.update(self.bucket_edges[bucket])
+        dx, dy = x1 - x0, y1 - y0
+        result = []
+        for n in edges:
+            ax, ay, bx, by = self.edges[n]
+            ex, ey = bx - ax, by - ay
+            denominator = dx * ey - dy * ex
+            if denominator == 0:
+                continue
+            wx, wy = ax - x0, ay - y0
+            t = (wx * ey - wy * ex) / denominator
+            s = (wx * dy - wy * dx) / denominator
+            if 0 < t < 1 and 0 <= s <= 1:
+                result.append(t)
+        # outside, the nearest point on the border switches between an edge and its ends on the lines
+        # perpendicular to the edge through its ends
+        for ax, ay, ex, ey, inv, z0, dz in self.border:
+            denominator = dx * ex + dy * ey
+            if denominator == 0:
+                continue
+            for px, py in ((ax, ay), (ax + ex, ay + ey)):
+                t = ((px - x0) * ex + (py - y0) * ey) / denominator
+                if 0 < t < 1:
+                    result.append(t)
+        result.sort()
+        return result
+
+# caches the offsets of a mesh by position rounded to resolution, moves keep visiting the same places
+# the offset at the rounded position is used, so results don't depend on the order of lookups
+# at most size offsets are kept, the least recently used one is dropped first
+# a new mesh is created whenever the profile or its matrix changes, which starts with an empty cache
+# numpy batches and crossings are passed to the mesh directly
+class CachedMesh(object):
+
+    def __init__(self, mesh, resolution, size):
+        self.mesh = mesh
+        self.resolution = float(resolution)
+        self.inverse = 1.0 / self.resolution
+        # two threads evicting at the same time must not empty it
+        self.size = max(int(size), 2)
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+        self.count_x = mesh.count_x
+        self.line_degree = mesh.line_degree
+        self.offsets = mesh.offsets
+        self.crossings = mesh.crossings
+
+    def offset(self, x, y):
+        key = (round(x * self.inverse), round(y * self.inverse))
+        cache = self.cache
+        # a hit is moved to the end by inserting it again
+        try:
+            value = cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = self.mesh.offset(key[0] * self.resolution, key[1] * self.resolution)
+            self.misses += 1
+            if len(cache) >= self.size:
+                cache.popitem(last = False)
+        cache[key] = value
+        return value
+
+    def to_dict(self):
+        return dict(hits = self.hits, misses = self.misses, entries = len(self.cache), size = self.size)
@@ -0,0 +1,61 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from octoprint.filemanager.util import LineProcessorStream
+from octoprint.util.comm import gcode_command_for_cmd
+import json
+import os
+
+# first line of a pre-leveled file, stores the profile and matrix version used for leveling
+# it's an @ command, so the plugin sees it while printing, in order with the lines of the file
+header_command = 'levelanything_prelevel'
+header_prefix = '@' + header_command + ' '
+
+# leveled copies are saved next to the original with this suffix, the original is kept to level it again
+leveled_suffix = '.leveled.gcode'
+
+def leveled_path(path):
+    return os.path.splitext(path)[0] + leveled_suffix
+
+# source is the path of the original file the copy was leveled from
+def make_header(profile_name, matrix_updated, source):
+    return header_prefix + json.dumps(dict(profile = profile_name, matrix_updated = matrix_updated, source = source))
+
+# returns the header data if the line is a pre-leveling header, None otherwise
+def read_header(line):
+    if not line.startswith(header_prefix):
+        return None
+    return parse_header(line[len(header_prefix):])
+
+# header data from the parameters of the @ command
+def parse_header(parameters):
+    try:
+        header = json.loads(parameters)
+    except ValueError:
+        return None
+    return header if isinstance(header, dict) else None
+
+# rewrites a G-code file line by line while it is being saved, the file is never loaded completely
+# the leveler must be a separate instance, the position of the file has nothing to do with the printer's
+class PrelevelStream(LineProcessorStream):
+
+    def __init__(self, input_stream, leveler, header):
+        LineProcessorStream.__init__(self, input_stream)
+        self.leveler = leveler
+        self.header = header
+        self.first_line = True
+
+    def process_line(self, line):
+        if self.first_line:
+            self.first_line = False
+            processed = self.process_line(line)
+            return (self.header + '\n').encode('utf-8') + (processed if processed is not None else b'')
+
+        cmd = line.decode('utf-8', 'replace').strip()
+        gcode = gcode_command_for_cmd(cmd)
+        if not gcode:
+            return line
+        commands = self.leveler.process(cmd, gcode)
+        if commands is None:
+            # command was only used for tracking, keep it as it is
+            return line
+        return ('\n'.join(commands) + '\n').encode('utf-8')
@@ -0,0 +1,427 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from threading import Lock, Thread
+import re
+
+# result of G30, lines not containing the literal aren't searched
+probe_literal = 'Bed X: '
+regex_probe = re.compile('Bed X: ([0-9\.\-]+) Y: ([0-9\.\-]+) Z: ([0-9\.\-]+)')
+regex_point = re.compile('^\s*([\-\d\.]+)[\s,;]+([\-\d\.]+)\s*$')
+
+# all points of the profile's grid as (matrix index, x, y), in the order they are stored in the matrix
+def grid_points(profile):
+    count_x, count_y = int(profile['count_x']), int(profile['count_y'])
+    # calculate distance between probe points
+    dist_x = (profile['max_x'] - profile['min_x']) / float(count_x - 1) if count_x > 1 else 0.0
+    dist_y = (profile['max_y'] - profile['min_y']) / float(count_y - 1) if count_y > 1 else 0.0
+    return [
+        (y * count_x + x, profile['min_x'] + dist_x * x, profile['min_y'] + dist_y * y)
+        for y in range(count_y) for x in range(count_x)
+    ]
+
+# points of a scattered profile as (matrix index, x, y), entered as one "x, y" per line
+# lines which aren't a point are ignored, so they can be used for comments
+def scattered_points(profile):
+    points = []
+    for line in profile.get('probe_points', '').splitlines():
+        match = regex_point.match(line)
+        if match:
+            try:
+                points.append((len(points), float(match.group(1)), float(match.group(2))))
+            except ValueError:
+                pass
+    return points
+
+# points reordered to reduce travel between them, results are still stored by their matrix index
+# raster: row by row, always from left to right
+# serpentine: row by row, every other row from right to left
+# shortest: nearest neighbor path, improved with 2-opt for grids up to shortest_max_points
+def order_points(points, order):
+    if order == 'shortest':
+        return shortest_path(points)
+    points = sorted(points, key = lambda p: (p[2], p[1]))
+    if order == 'serpentine':
+        rows = [list(row) for y, row in groupby(points, key = lambda p: p[2])]
+        return [p for n, row in enumerate(rows) for p in (row if n % 2 == 0 else reversed(row))]
+    return points
+
+shortest_max_points = 400
+
+def distance(a, b):
+    return ((a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2) ** 0.5
+
+def shortest_path(points):
+    if len(points) < 3:
+        return list(points)
+    # greedy nearest neighbor, starting at the first point
+    remaining = list(points[1:])
+    path = [points[0]]
+    while remaining:
+        last = path[-1]
+        nearest = min(range(len(remaining)), key = lambda i: (remaining[i][1] - last[1]) ** 2 + (remaining[i][2] - last[2]) ** 2)
+        path.append(remaining.pop(nearest))
+    if len(path) > shortest_max_points:
+        return path
+
+    # 2-opt on the open path: reverse sections as long as that makes the path shorter
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                before = distance(path[i - 1], path[i])
+                after = distance(path[i - 1], path[j])
+                if j + 1 < len(path):
+                    before += distance(path[j], path[j + 1])
+                    after += distance(path[i], path[j + 1])
+                if after < before - 1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+    return path
+
+# z and variance of repeated readings of one point, readings further than mad_factor times the scaled median
+# absolute deviation from the median are rejected as outliers, z is the mean of the remaining ones
+# returns z, variance and the number of remaining readings
+mad_factor = 3.0
+
+def sample_stats(readings):
+    values = sorted(readings)
+    median = median_of(values)
+    mad = median_of(sorted(abs(v - median) for v in values))
+    # 1.4826 scales the MAD to the standard deviation of normally distributed readings
+    limit = mad_factor * 1.4826 * mad + 1e-9
+    inliers = [v for v in values if abs(v - median) <= limit]
+    z = sum(inliers) / len(inliers)
+    variance = sum((v - z) ** 2 for v in inliers) / (len(inliers) - 1) if len(inliers) > 1 else 0.0
+    return z, variance, inliers
+
+def median_of(values):
+    n = len(values)
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+# probes a list of points without blocking a thread while waiting for the printer
+# the commands for the next points are queued while the current G30 is still running, so the printer
+# doesn't wait for the host between points, a response is expected for every G30 in the order they were sent
+# with probe_samples above 1, every point is probed repeatedly in place until the readings agree within probe_spread
+# or probe_samples is reached, the next point can't be queued then, results get their variance as fourth value
+# points are ordered by probe_order in start, which can take a while, so it runs on a thread of its own
+# states: PROBING while running, then IDLE when finished, CANCEL or ERROR
+class ProbeJob(object):
+    # number of points with queued commands at the same time
+    window = 2
+
+    def __init__(self, profile, points, responses, timeout, debug, send, set_status, send_point, finish, home = True):
+        self.profile = profile
+        self.points = points
+        # ResponseRegistry of the plugin
+        self.responses = responses
+        self.timeout = timeout
+        self.debug = debug
+        # callbacks to the plugin
+        self.send = send
+        self.set_status = set_status
+        self.send_point = send_point
+        self.finish = finish
+        self.home = home
+
+        self.state = 'PROBING'
+        self.lock = Lock()
+        self.matrix = [None] * len(points)
+        # number of points sent to the printer which are still waiting for their result
+        self.pending = 0
+        self.next = 0
+        self.done = 0
+        self.derivation = None
+        self.samples = max(int(profile.get('probe_samples', 1)), 1)
+        self.spread = float(profile.get('probe_spread', 0))
+        # readings of the current point while sampling
+        self.readings = []
+        if self.samples > 1:
+            self.window = 1
+
+    def start(self):
+        # the shortest path takes a noticeable time for large grids, it's calculated before locking
+        points = order_points(self.points, self.profile['probe_order'])
+        with self.lock:
+            if self.state != 'PROBING':
+                # cancelled while ordering
+                return
+            self.points = points
+            if self.home and self.profile['safe_homing']:
+                # home first to prevent probe missing the bed
+                # if safe homing is disabled, the user must home the carriage
+                self.send(['G28'])
+            self.set_status('PROBING', 'Probing point 1 of %d...' % len(self.points))
+            self.fill()
+
+    def cancel(self):
+        with self.lock:
+            if self.state == 'PROBING':
+                self.stop('CANCEL', 'Probing cancelled, matrix not saved')
+
+    # called with the response to the G30 of a point, on the thread receiving from the printer
+    def on_result(self, point, match):
+        if self.record(point, match):
+            # saving the matrix or starting the next adaptive pass takes a while, the printer's responses can't wait
+            Thread(target = self.finish, args = [self.matrix]).start()
+
+    # returns True once all points are probed
+    def record(self, point, match):
+        with self.lock:
+            if self.state != 'PROBING':
+                return False
+            self.pending -= 1
+            index, x, y = point
+
+            # extract result from regex match
+            act_x = float(match.group(1)) - self.profile['offset_x']
+            act_y = float(match.group(2)) - self.profile['offset_y']
+            act_z = float(match.group(3))
+
+            # marlin ignores shifted coordinates (G92) for G30, adapt coordinate space dynamically
+            if self.derivation is None:
+                self.derivation = [act_x - x, act_y - y]
+            act_x, act_y = act_x - self.derivation[0], act_y - self.derivation[1]
+            # compare the points we want to the actual position reported by the printer
+            if abs(act_x - x) >= 0.1 or abs(act_y - y) >= 0.1:
+                self.stop('ERROR', 'Probing failed: Coordinates mismatch, expected %.3f, %.3f, got %.3f, %.3f' % (
+                    x, y, act_x, act_y
+                ))
+                return False
+
+            if self.samples > 1:
+                self.readings.append(act_z)
+                z, variance, inliers = sample_stats(self.readings)
+                # done when most readings agree within the spread, or there are enough readings
+                agree = len(inliers) * 2 > len(self.readings) and inliers[-1] - inliers[0] <= self.spread
+                if len(self.readings) < self.samples and (len(self.readings) < 2 or not agree):
+                    self.sample((index, x, y))
+                    return False
+                self.readings = []
+                self.matrix[index] = [x, y, z, variance]
+            else:
+                self.matrix[index] = [x, y, act_z]
+
+            # send probe result to front-end
+            self.send_point(self.matrix[index])
+            self.done += 1
+            if self.done == len(self.points):
+                self.state = 'IDLE'
+                return True
+            self.set_status('PROBING', 'Probing point %d of %d...' % (self.done + 1, len(self.points)))
+            self.fill()
+            return False
+
+    # queue commands for the next points until the window is full
+    def fill(self):
+        while self.next < len(self.points) and self.pending < self.window:
+            point = self.points[self.next]
+            self.next += 1
+            self.expect(point)
+            self.send(self.point_commands(point[1], point[2]))
+
+    # probe the current point again without moving
+    def sample(self, point):
+        self.expect(point)
+        self.send(self.point_commands(point[1], point[2], False))
+
+    # register the response before sending the commands, so it can't arrive first
+    # the timeout starts once all earlier points have their result
+    def expect(self, point):
+        self.pending += 1
+        self.responses.expect(
+            probe_literal, regex_probe, self.timeout,
+            lambda match: self.on_result(point, match), lambda: self.on_timeout(point)
+        )
+
+    def point_commands(self, x, y, move = True):
+        cmd = []
+        # lift carriage if enabled
+        if self.profile['lift'] > 0:
+            cmd.extend(['G91', 'G0 Z%.3f' % self.profile['lift']])
+        cmd.append('G90')
+        # send movement command and G30 to execute Z probe at position
+        if move:
+            cmd.append('G0 X%.3f Y%.3f F%.3f' % (
+                x + self.profile['offset_x'], y + self.profile['offset_y'], self.profile['home_feed']
+            ))
+        cmd.append('G30')
+        if self.debug:
+            # fake G30 response on virtual printer
+            cmd.append('!!DEBUG:send Bed X: %.3f Y: %.3f Z: %.3f' % (
+                x + self.profile['offset_x'], y + self.profile['offset_y'], 0.5
+            ))
+        return cmd
+
+    def on_timeout(self, point):
+        with self.lock:
+            if self.state == 'PROBING':
+                self.stop('ERROR', 'Probing at location %.3f, %.3f timed out' % (point[1], point[2]))
+
+    def stop(self, state, text):
+        # responses to commands which are still queued are ignored
+        self.responses.clear()
+        self.state = state
+        self.set_status(state, text)
+
+# probes the profile's grid, then refines it where the surface isn't flat
+# the center of every cell is probed and compared to the interpolation, cells deviating more than refine_tolerance
+# are split into four by new grid lines through the center, up to refine_depth times
+# the new lines are probed around the split cells, all other points on them are interpolated, which keeps the
+# surface unchanged there, so the result is a complete (unequally spaced) grid stored row by row
+class AdaptiveProbe(object):
+
+    def __init__(self, profile, responses, timeout, debug, send, set_status, send_point, finish):
+        self.profile = profile
+        self.responses = responses
+        self.timeout = timeout
+        self.debug = debug
+        self.send = send
+        self.plugin_status = set_status
+        self.send_point = send_point
+        self.finish = finish
+
+        points = grid_points(profile)
+        self.xs = sorted(set(p[1] for p in points))
+        self.ys = sorted(set(p[2] for p in points))
+        # z of every grid point by position, and the positions which were actually probed
+        self.z = dict()
+        self.probed = set()
+        # variance of the probed points if they were sampled repeatedly
+        self.variance = dict()
+        # cells which are checked in the next pass as (x0, x1, y0, y1)
+        self.cells = [
+            (self.xs[i], self.xs[i + 1], self.ys[j], self.ys[j + 1])
+            for j in range(len(self.ys) - 1) for i in range(len(self.xs) - 1)
+        ]
+        self.depth = 0
+        self.finished = False
+        # set by cancel, which finds the job idle if it's called between two passes
+        self.cancelled = False
+        # protects cancelled and replacing the job
+        self.lock = Lock()
+        self.job = self.make_job(points, self.on_grid, True)
+
+    # the current job is idle between two passes, but probing isn't finished yet
+    @property
+    def state(self):
+        if self.job.state == 'IDLE' and not self.finished:
+            return 'CANCEL' if self.cancelled else 'PROBING'
+        return self.job.state
+
+    def start(self):
+        self.job.start()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            job = self.job
+        job.cancel()
+
+    def make_job(self, points, finish, home = False):
+        points = [(n, p[1], p[2]) for n, p in enumerate(points)]
+        return ProbeJob(
+            self.profile, points, self.responses, self.timeout, self.debug,
+            self.send, self.set_status, self.send_point, finish, home
+        )
+
+    # passes after the first are started when the previous one finished, on the thread it finished on
+    def run(self, points, finish):
+        with self.lock:
+            if self.cancelled:
+                self.set_status('CANCEL', 'Probing cancelled, matrix not saved')
+                return
+            self.job = self.make_job(points, finish)
+        self.job.start()
+
+    def set_status(self, status, text):
+        if status == 'PROBING' and self.depth > 0:
+            text = 'Refinement pass %d: %s%s' % (self.depth, text[0].lower(), text[1:])
+        self.plugin_status(status, text)
+
+    def store(self, matrix):
+        for point in matrix:
+            x, y, z = point[:3]
+            self.z[(x, y)] = z
+            self.probed.add((x, y))
+            if len(point) > 3:
+                self.variance[(x, y)] = point[3]
+
+    def on_grid(self, matrix):
+        self.store(matrix)
+        self.next_pass()
+
+    def next_pass(self):
+        if not self.cells or self.depth >= int(self.profile['refine_depth']):
+            self.done()
+            return
+        self.depth += 1
+        self.run([(0, (x0 + x1) / 2, (y0 + y1) / 2) for x0, x1, y0, y1 in self.cells], self.on_centers)
+
+    def on_centers(self, matrix):
+        tolerance = float(self.profile['refine_tolerance'])
+        split = [(cell, p) for cell, p in zip(self.cells, matrix) if abs(p[2] - self.interpolate(p[0], p[1])) > tolerance]
+        if not split:
+            self.done()
+            return
+
+        # add the new lines with interpolated points first, then replace them with probed values
+        for cell, p in split:
+            self.insert(self.xs, (cell[0] + cell[1]) / 2, lambda x, y: (x, y))
+        for cell, p in split:
+            self.insert(self.ys, (cell[2] + cell[3]) / 2, lambda y, x: (x, y))
+        self.store([p for cell, p in split])
+
+        # the centers of the edges of every split cell are probed next, then its four quarters are checked
+        edges = []
+        self.cells = []
+        for (x0, x1, y0, y1), p in split:
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+            for point in ((cx, y0), (cx, y1), (x0, cy), (x1, cy)):
+                if point not in self.probed and point not in edges:
+                    edges.append(point)
+            self.cells.extend(((x0, cx, y0, cy), (cx, x1, y0, cy), (x0, cx, cy, y1), (cx, x1, cy, y1)))
+        if edges:
+            self.run([(0, x, y) for x, y in edges], self.on_edges)
+        else:
+            self.next_pass()
+
+    def on_edges(self, matrix):
+        self.store(matrix)
+        self.next_pass()
+
+    # insert a grid line, the points on it are interpolated between the neighboring lines
+    # key maps (position on this axis, position on the other axis) to the point's position
+    def insert(self, lines, value, key):
+        k = bisect_left(lines, value)
+        if k < len(lines) and lines[k] == value:
+            return
+        low, high = lines[k - 1], lines[k]
+        t = (value - low) / (high - low)
+        for other in (self.ys if lines is self.xs else self.xs):
+            z0, z1 = self.z[key(low, other)], self.z[key(high, other)]
+            self.z[key(value, other)] = z0 + (z1 - z0) * t
+        lines.insert(k, value)
+
+    # bilinear interpolation of the current grid, only used inside the grid
+    def interpolate(self, x, y):
+        i = min(max(bisect_right(self.xs, x) - 1, 0), len(self.xs) - 2)
+        j = min(max(bisect_right(self.ys, y) - 1, 0), len(self.ys) - 2)
+        x0, x1, y0, y1 = self.xs[i], self.xs[i + 1], self.ys[j], self.ys[j + 1]
+        u, v = (x - x0) / (x1 - x0), (y - y0) / (y1 - y0)
+        z0 = self.z[(x0, y0)] + (self.z[(x1, y0)] - self.z[(x0, y0)]) * u
+        z1 = self.z[(x0, y1)] + (self.z[(x1, y1)] - self.z[(x0, y1)]) * u
+        return z0 + (z1 - z0) * v
+
+    def done(self):
+        with self.lock:
+            if self.cancelled:
+                self.set_status('CANCEL', 'Probing cancelled, matrix not saved')
+                return
+            self.finished = True
+        self.finish([
+            [x, y, self.z[(x, y)]] + ([self.variance[(x, y)]] if (x, y) in self.variance else [])
+            for y in self.ys for x in self.xs
+        ])
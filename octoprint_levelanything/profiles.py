@@ -0,0 +1,156 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from octoprint.util import atomic_write
+from array import array
+import binascii
+import json
+import mmap
+import os
+import struct
+import sys
+
+# matrix file: magic, number of points, then x/y/z of every point as little endian doubles
+matrix_magic = b'LAM1'
+matrix_header = struct.Struct('<4sI')
+
+# the file is mapped into memory and unpacked directly from there, without reading it into a buffer first
+def read_matrix_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < matrix_header.size:
+            raise ValueError('%s is not a matrix file' % path)
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            magic, count = matrix_header.unpack_from(data)
+            if magic != matrix_magic or len(data) < matrix_header.size + count * 24:
+                raise ValueError('%s is not a matrix file' % path)
+            return struct.unpack_from(str('<%dd' % (count * 3)), data, matrix_header.size)
+        finally:
+            data.close()
+
+def write_matrix_file(path, matrix):
+    values = array(str('d'), (float(v) for point in matrix for v in point[:3]))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    with atomic_write(path, mode = 'wb') as f:
+        f.write(matrix_header.pack(matrix_magic, len(matrix)))
+        values.tofile(f)
+
+# matrix as little endian float32 x/y/z of every point, the compact format sent to the UI
+def pack_matrix(matrix):
+    values = array(str('f'), (float(v) for point in matrix for v in point[:3]))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+# keeps the parsed profiles in memory, the settings only store them without their matrices
+# the matrix of every profile is saved as a binary file, it's only written after probing
+# if the points were sampled repeatedly, their variance is saved as x/y/variance in a second file of the same format
+class ProfileStore(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.raw = None
+        self.profiles = dict()
+        # incremented whenever any profile or matrix changes
+        self.version = 0
+
+    def matrix_path(self, name, suffix = '.bin'):
+        return os.path.join(self.folder, binascii.hexlify(name.encode('utf-8')).decode('ascii') + suffix)
+
+    def variance_path(self, name):
+        return self.matrix_path(name, '.variance.bin')
+
+    # parse profiles from the settings string, skipped if the string didn't change since the last call
+    def load(self, raw):
+        if raw == self.raw:
+            return False
+        profiles = json.loads(raw)
+        for name, profile in profiles.items():
+            if not profile.get('matrix'):
+                profile['matrix'] = self.read_matrix(name)
+            if not profile.get('matrix_variance'):
+                profile['matrix_variance'] = self.read_matrix(name, self.variance_path(name))
+        self.raw = raw
+        self.profiles = profiles
+        self.version += 1
+        return True
+
+    def read_matrix(self, name, path = None):
+        path = path or self.matrix_path(name)
+        if not os.path.isfile(path):
+            return []
+        values = read_matrix_file(path)
+        return [[values[i], values[i + 1], values[i + 2]] for i in range(0, len(values), 3)]
+
+    def write_matrix(self, name, matrix, path = None):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        write_matrix_file(path or self.matrix_path(name), matrix)
+
+    # store a new matrix for a profile, returns the settings string which has to be saved
+    # variance is a list of x/y/variance, empty if the points weren't sampled repeatedly
+    def save_matrix(self, name, matrix, updated, variance = None):
+        self.write_matrix(name, matrix)
+        if variance:
+            self.write_matrix(name, variance, self.variance_path(name))
+        elif os.path.isfile(self.variance_path(name)):
+            os.remove(self.variance_path(name))
+        self.profiles[name]['matrix'] = matrix
+        self.profiles[name]['matrix_variance'] = variance or []
+        self.profiles[name]['matrix_updated'] = updated
+        self.raw = self.dumps()
+        self.version += 1
+        return self.raw
+
+    def delete_matrix(self, name):
+        for path in (self.matrix_path(name), self.variance_path(name)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    # settings string of the given profiles, without their matrices
+    def dumps(self, profiles = None):
+        profiles = self.profiles if profiles is None else profiles
+        return json.dumps(dict(
+            (name, dict(profile, matrix = [], matrix_variance = [])) for name, profile in profiles.items()
+        ))
+
+# the values of a profile used while rewriting commands, together with its mesh
+# created whenever the profile or its matrix changes and never modified, so the thread sending commands always
+# sees a complete profile, it's replaced by assigning a new snapshot
+# derived values are calculated once here instead of for every command
+class ProfileSnapshot(object):
+    __slots__ = (
+        'mesh', 'fade', 'fade_inv', 'divide', 'divide_tolerance', 'arc_tolerance', 'coalesce_tolerance', 'safe_homing',
+        'lift', 'offset_command', 'lift_command', 'home_command'
+    )
+
+    def __init__(self, profile, mesh):
+        values = dict(
+            mesh = mesh,
+            fade = float(profile['fade']),
+            # 0 if fading is disabled
+            fade_inv = 1.0 / float(profile['fade']) if float(profile['fade']) > 0 else 0.0,
+            divide = float(profile['divide']),
+            # the error of adaptive subdivision is only bounded if the offset is a parabola between grid lines,
+            # other meshes are divided evenly
+            divide_tolerance = (
+                float(profile['divide_tolerance']) if mesh is not None and mesh.line_degree <= 2 else 0.0
+            ),
+            arc_tolerance = float(profile['arc_tolerance']),
+            coalesce_tolerance = float(profile['coalesce_tolerance']),
+            safe_homing = bool(profile['safe_homing']),
+            lift = float(profile['lift']),
+            # commands inserted when homing
+            offset_command = 'M851 Z%.3f' % float(profile['offset_z']),
+            lift_command = 'G0 Z%.3f F%.3f' % (float(profile['lift']), float(profile['lift_feed'])),
+            home_command = 'G0 X%.3f Y%.3f F%.3f' % (
+                float(profile['home_x']) + float(profile['offset_x']),
+                float(profile['home_y']) + float(profile['offset_y']),
+                float(profile['home_feed'])
+            )
+        )
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ProfileSnapshot is immutable')
@@ -0,0 +1,90 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from collections import deque
+from threading import Lock, Timer
+
+# a response expected from the printer
+# literal: text the response must contain, checked before the regex is run
+# regex: compiled pattern searched in lines containing the literal
+# on_match: called with the match object, on_timeout: called if no response arrived in time
+# result: the match object once the response arrived
+class Expectation(object):
+    __slots__ = ('literal', 'regex', 'timeout', 'on_match', 'on_timeout', 'result', 'timer')
+
+    def __init__(self, literal, regex, timeout, on_match, on_timeout):
+        self.literal = literal
+        self.regex = regex
+        self.timeout = timeout
+        self.on_match = on_match
+        self.on_timeout = on_timeout
+        self.result = None
+        self.timer = None
+
+# responses which are still expected, matched in the order they were registered, like the printer sends them
+# only the oldest one is checked against received lines, its timeout starts when it becomes the oldest, so
+# responses waiting behind a slow command don't time out
+# callbacks are called without holding the lock, they may register new expectations
+class ResponseRegistry(object):
+
+    def __init__(self):
+        self.pending = deque()
+        self.lock = Lock()
+
+    def expect(self, literal, regex, timeout, on_match, on_timeout):
+        expectation = Expectation(literal, regex, timeout, on_match, on_timeout)
+        with self.lock:
+            self.pending.append(expectation)
+            if len(self.pending) == 1:
+                self.start_timer(expectation)
+        return expectation
+
+    # called for every line received from the printer, returns True if it was an expected response
+    # on_match runs on the thread receiving from the printer, so it must return quickly and leave slow work, like
+    # saving a matrix, to another thread
+    def on_line(self, line):
+        try:
+            first = self.pending[0]
+        except IndexError:
+            return False
+        # most lines are temperatures, busy messages and oks, they don't get to the regex
+        if first.literal not in line:
+            return False
+        match = first.regex.search(line)
+        if match is None:
+            return False
+        with self.lock:
+            if not self.pending or self.pending[0] is not first:
+                return False
+            self.pending.popleft()
+            self.stop_timer(first)
+            first.result = match
+            if self.pending:
+                self.start_timer(self.pending[0])
+        first.on_match(match)
+        return True
+
+    # forget all expected responses
+    def clear(self):
+        with self.lock:
+            for expectation in self.pending:
+                self.stop_timer(expectation)
+            self.pending.clear()
+
+    def on_timer(self, expectation):
+        with self.lock:
+            if not self.pending or self.pending[0] is not expectation:
+                return
+            self.pending.popleft()
+            if self.pending:
+                self.start_timer(self.pending[0])
+        expectation.on_timeout()
+
+    def start_timer(self, expectation):
+        expectation.timer = Timer(expectation.timeout, self.on_timer, [expectation])
+        expectation.timer.daemon = True
+        expectation.timer.start()
+
+    def stop_timer(self, expectation):
+        if expectation.timer is not None:
+            expectation.timer.cancel()
+            expectation.timer = None
@@ -0,0 +1,61 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+from .profiles import read_matrix_file, write_matrix_file
+from contextlib import contextmanager
+import binascii
+import os
+
+# file locks are only available on unix, elsewhere the atomic replacement of files has to be enough
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# holds a lock on a separate lock file, shared for reading, exclusive for writing
+@contextmanager
+def locked(path, exclusive):
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# matrices shared by several OctoPrint instances through a common folder, one file per fixture id
+# any instance probing a fixture updates its file, the others pick it up by its modification time
+class SharedMeshCache(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def matrix_path(self, fixture):
+        return os.path.join(self.folder, binascii.hexlify(fixture.encode('utf-8')).decode('ascii') + '.bin')
+
+    # modification time of the fixture's matrix, None if there is none
+    def mtime(self, fixture):
+        try:
+            return os.stat(self.matrix_path(fixture)).st_mtime
+        except OSError:
+            return None
+
+    # returns the matrix and its modification time, or None if there is no matrix for the fixture
+    def read(self, fixture):
+        path = self.matrix_path(fixture)
+        with locked(path + '.lock', False):
+            mtime = self.mtime(fixture)
+            if mtime is None:
+                return None
+            values = read_matrix_file(path)
+        return [[values[i], values[i + 1], values[i + 2]] for i in range(0, len(values), 3)], mtime
+
+    # stores the matrix for all instances, returns its modification time
+    def write(self, fixture, matrix):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = self.matrix_path(fixture)
+        with locked(path + '.lock', True):
+            write_matrix_file(path, matrix)
+            return self.mtime(fixture)
@@ -24,6 +24,8 @@ $(function() {
             self.isProbing(true);
             var selectedProfile = self.profiles[self.selectedProfileName()];
             for (key in selectedProfile) if (selectedProfile.hasOwnProperty(key)) {
+                // matrices are only changed by probing, don't send them back
+                if (key == 'matrix' || key == 'matrix_variance') continue;
                 if (typeof selectedProfile[key] == 'number') selectedProfile[key] = parseFloat(self.profile[key]());
                 else selectedProfile[key] = self.profile[key]();
             }
@@ -34,8 +36,12 @@ $(function() {
         }
         self.probeStartClick = function() {
             self.profile.matrix([]);
+            // the matrix has to be downloaded again if probing doesn't finish
+            self.matrixVersion = null;
             var selectedProfile = self.profiles[self.selectedProfileName()];
             for (key in selectedProfile) if (selectedProfile.hasOwnProperty(key)) {
+                // matrices are only changed by probing, don't send them back
+                if (key == 'matrix' || key == 'matrix_variance') continue;
                 if (typeof selectedProfile[key] == 'number') selectedProfile[key] = parseFloat(self.profile[key]());
                 else selectedProfile[key] = self.profile[key]();
             }
@@ -109,17 +115,19 @@ $(function() {
                     self.profile[key] = ko.observable(selectedProfile[key]);
                 }
             }
+            self.loadMatrix();
 
             // subscribe for event when user changes profile selection
             self.selectedProfileName.subscribe(function(selected) {
                 // update disabled observable which hides/disables controls when plugin is inactive
                 self.isDisabled(selected == DISABLED);
 
-                // update all values
+                // update all values, the matrix is downloaded separately
                 var selectedProfile = self.profiles[self.selectedProfileName()];
                 for (key in self.profile) if (self.profile.hasOwnProperty(key)) {
-                    self.profile[key](selectedProfile[key]);
+                    if (key != 'matrix') self.profile[key](selectedProfile[key]);
                 }
+                self.loadMatrix();
 
                 // save currently selected profile to persist restarts
                 var data = { plugins: { levelanything: { selected_profile: selected } } };
@@ -135,16 +143,29 @@ $(function() {
             else if (message.status) {
                 self.statusText(message.text);
                 self.isProbing(message.status == 'PROBING');
+                if (message.status == 'CANCEL' || message.status == 'ERROR') self.loadMatrix();
             }
-            else if (message.point) {
-                self.profile.matrix.push(message.point);
+            else if (message.warning) {
+                new PNotify({ title: 'Level Anything', text: message.warning, type: 'error', hide: false });
+            }
+            else if (message.points) {
+                // only draw the new points, without notifying the observable which would redraw all of them
+                var selectedProfile = self.profiles[self.selectedProfileName()];
+                var matrix = self.profile.matrix.peek();
+                for (var i = 0; i < message.points.length; i++) {
+                    matrix.push(message.points[i]);
+                    self.drawPoint(message.points[i], selectedProfile);
+                }
             }
             else if (message.profile) {
                 // profile change from server, update local cache
-                var selectedProfile = self.profiles[self.selectedProfileName()]
+                self.profiles[self.selectedProfileName()] = message.profile;
+                var selectedProfile = message.profile;
                 for (key in selectedProfile) if (selectedProfile.hasOwnProperty(key)) {
-                    self.profile[key](selectedProfile[key]);
+                    if (key != 'matrix') self.profile[key](selectedProfile[key]);
                 }
+                // download the matrix if it changed
+                self.loadMatrix();
             }
         }
         // an observable implementation for displaying the probe matrix with live changes
@@ -155,18 +176,57 @@ $(function() {
                 CTX.clearRect(0, 0, SIZE, SIZE);
                 CTX.strokeRect(1, 1, SIZE - 2, SIZE - 2);
                 for (var i = 0; i < matrix.length; i++) {
-                    factX = (SIZE - PADDING * 2) / (selectedProfile.max_x - selectedProfile.min_x);
-                    factY = (SIZE - PADDING * 2) / (selectedProfile.max_y - selectedProfile.min_y);
-                    CTX.fillText(
-                        matrix[i][2],
-                        (matrix[i][0] - selectedProfile.min_x) * factX + PADDING,
-                        (matrix[i][1] - selectedProfile.min_y) * factY + PADDING
-                    );
+                    self.drawPoint(matrix[i], selectedProfile);
                 }
             });
             observable(matrix);
             return observable;
         };
+        // download the matrix of the selected profile, unless the one shown is already up to date
+        // it's sent as float32 x, y, z of every point, which is a lot smaller and faster to parse than JSON
+        self.loadMatrix = function() {
+            var name = self.selectedProfileName();
+            var version = name + '@' + self.profiles[name].matrix_updated;
+            if (self.matrixName != name) {
+                // don't show the matrix of another profile while downloading
+                self.profile.matrix([]);
+            }
+            if (self.matrixVersion == version) return;
+            self.matrixName = name;
+            self.matrixVersion = version;
+            var request = new XMLHttpRequest();
+            request.open('GET', API_BASEURL + 'plugin/levelanything?matrix=' + encodeURIComponent(name));
+            request.responseType = 'arraybuffer';
+            request.onload = function() {
+                // ignore outdated responses if the profile or matrix changed meanwhile
+                if (request.status != 200 || self.matrixVersion != version) return;
+                var data = new DataView(request.response);
+                var matrix = [];
+                for (var offset = 0; offset + 12 <= data.byteLength; offset += 12) {
+                    matrix.push([
+                        data.getFloat32(offset, true),
+                        data.getFloat32(offset + 4, true),
+                        data.getFloat32(offset + 8, true)
+                    ]);
+                }
+                self.profile.matrix(matrix);
+            };
+            request.onerror = function() {
+                self.matrixVersion = null;
+            };
+            request.send();
+        };
+        // draw a single point of the matrix onto the canvas
+        self.drawPoint = function(point, profile) {
+            var factX = (SIZE - PADDING * 2) / (profile.max_x - profile.min_x);
+            var factY = (SIZE - PADDING * 2) / (profile.max_y - profile.min_y);
+            CTX.fillText(
+                // float32 values are rounded to the precision the printer reports
+                +point[2].toFixed(3),
+                (point[0] - profile.min_x) * factX + PADDING,
+                (point[1] - profile.min_y) * factY + PADDING
+            );
+        };
         // send a JSON command to python
         self.sendJSON = function(content) {
             $.ajax({
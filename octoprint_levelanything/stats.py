@@ -0,0 +1,89 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function, unicode_literals
+import math
+
+# latency histogram with logarithmic buckets, from 1 microsecond to about 10 seconds
+# recording is a single log and an increment, percentiles are approximated by the bucket's upper bound
+class LatencyHistogram(object):
+    base = 1e-6
+    ratio = 2 ** 0.25
+    size = 96
+
+    def __init__(self):
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > self.base:
+            index = min(int(math.log(seconds / self.base) / math.log(self.ratio)) + 1, self.size - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        wanted = p / 100.0 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= wanted:
+                return min(self.base * self.ratio ** index, self.max)
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            count = self.count,
+            total = self.total,
+            mean = self.total / self.count if self.count else 0.0,
+            p50 = self.percentile(50),
+            p99 = self.percentile(99),
+            max = self.max
+        )
+
+# counters for the queuing hook, all times in seconds
+class HookStats(object):
+
+    def __init__(self):
+        # CachedMesh of the selected profile if offsets are cached
+        self.offset_cache = None
+        self.reset()
+
+    def reset(self):
+        if self.offset_cache is not None:
+            self.offset_cache.hits = self.offset_cache.misses = 0
+        self.lines_processed = 0
+        self.lines_rewritten = 0
+        self.segments_emitted = 0
+        self.hook = LatencyHistogram()
+        self.interpolations = 0
+        self.interpolation_time = 0.0
+
+    # a line passed the hook, commands is what the hook returned
+    def add_line(self, seconds, commands):
+        self.lines_processed += 1
+        self.hook.record(seconds)
+        if commands is not None:
+            self.lines_rewritten += 1
+            self.segments_emitted += len(commands)
+
+    def add_interpolation(self, seconds, count = 1):
+        self.interpolations += count
+        self.interpolation_time += seconds
+
+    def to_dict(self):
+        return dict(
+            lines_processed = self.lines_processed,
+            lines_rewritten = self.lines_rewritten,
+            segments_emitted = self.segments_emitted,
+            hook = self.hook.to_dict(),
+            interpolations = self.interpolations,
+            interpolation_time = self.interpolation_time,
+            offset_cache = self.offset_cache.to_dict() if self.offset_cache is not None else None
+        )